@@ -9,28 +9,63 @@
 # ================================================================================
 
 
-from inc_noesis import *
+# The decoding core (DrmIndex, SectionList, the read* parsers and their Data classes) only
+# uses the standard library, so the file can also be imported and used without Noesis
+
+try:
+    from inc_noesis import *
+except ImportError:
+    import struct
+    noesis = None
+    rapi = None
+
 import math
 import re
 import copy
+import zlib
+import mmap
+import itertools
+import concurrent.futures
+import functools
+import operator
+import array
+import os
+import time
+import argparse
 
 SECTION_TEXTURE = 5
 
+
+# Payloads are sliced out of a memoryview over the input buffer (or an mmap of the file when
+# reading from disk), so nothing is copied until the data is handed over to Noesis
+
+def mapFile(path):
+    with open(path, "rb") as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ))
+
 def registerNoesisTypes():
 
     def addOptions(handle):
         noesis.addOption(handle, "-noguns", "Remove the holstered guns attachment", 0)
         noesis.addOption(handle, "-noshotgun", "Remove the holstered shotgun attachment", 0)
         noesis.addOption(handle, "-nogear", "Remove all the gear attachments (grapple hook excluded)", 0)
+        noesis.addOption(handle, "-template", "Path of 5_0.tr7aemesh from lara.drm, instead of asking for it", noesis.OPTFLAG_WANTARG)
+        noesis.addOption(handle, "-weldepsilon", "Weld vertices closer than <arg> (default 0.00001, 0 to keep every vertex)", noesis.OPTFLAG_WANTARG)
+        return handle
+
+    def addTextureOptions(handle):
+        noesis.addOption(handle, "-usedtextures", "Only decode the textures referenced by the meshes", 0)
         return handle
 
     handle = noesis.register("TR7AE BGObjects (PC)", ".drm")
     noesis.setHandlerTypeCheck(handle, checkType)
     noesis.setHandlerLoadModel(handle, loadLevel)
+    addTextureOptions(handle)
 
     handle = noesis.register("TR7AE DRM (PC)",".drm")
     noesis.setHandlerTypeCheck(handle, bcCheckType)
     noesis.setHandlerLoadModel(handle, bcLoadModel)
+    addTextureOptions(handle)
     
     handle = noesis.register("TR7AE Mesh (PC)",".tr7aemesh")
     noesis.setHandlerTypeCheck(handle, bdCheckType)
@@ -42,18 +77,28 @@ def registerNoesisTypes():
     noesis.setHandlerTypeCheck(handle, pcdCheckType)
     noesis.setHandlerLoadRGBA(handle, pcdLoadDDS)
     noesis.setHandlerWriteRGBA(handle, pcdWriteRGBA)
+    noesis.addOption(handle, "-mipfilter", "Mipmap filter, <arg> is resample (default) or box", noesis.OPTFLAG_WANTARG)
+    noesis.addOption(handle, "-regenmips", "Rebuild the mipmaps even if the DDS already has them", 0)
     
     handle = noesis.register("TR7AE Texture (PS3)", ".pcd")
     noesis.setHandlerLoadRGBA(handle, ps3pcdLoadDDS)
+    noesis.setHandlerWriteRGBA(handle, ps3pcdWriteRGBA)
+    noesis.addOption(handle, "-mipfilter", "Mipmap filter, <arg> is resample (default) or box", noesis.OPTFLAG_WANTARG)
+    noesis.addOption(handle, "-regenmips", "Rebuild the mipmaps even if the DDS already has them", 0)
     
     handle = noesis.register("TR7AE RAW (PC)", ".raw")
     noesis.setHandlerTypeCheck(handle, rawCheckType)
     noesis.setHandlerLoadRGBA(handle, rawLoadDDS)
     noesis.setHandlerWriteRGBA(handle, rawWriteRGBA)
+    noesis.addOption(handle, "-mipfilter", "Mipmap filter, <arg> is resample (default) or box", noesis.OPTFLAG_WANTARG)
     
     handle = noesis.register("TR7AE Raw Texture (PS3)", ".raw")
     noesis.setHandlerTypeCheck(handle, ps3rawCheckType)
     noesis.setHandlerLoadRGBA(handle, ps3rawLoadDDS)
+    noesis.setHandlerWriteRGBA(handle, ps3rawWriteRGBA)
+    noesis.addOption(handle, "-mipfilter", "Mipmap filter, <arg> is resample (default) or box", noesis.OPTFLAG_WANTARG)
+    
+    handle = noesis.registerTool("TR7AE Batch Textures to PCD", pcdBatchTool, "Convert a directory of DDS/PNG textures named <n>_<id> to PC .pcd files")
     
     return 1
 
@@ -72,41 +117,23 @@ def bcCheckType(data):
 # Read the model data
 
 def bcLoadModel(data, mdlList):
-    bs = NoeBitStream(data)
-
-    tex_list, mat_list = ReadTextures(bs)
-
+    view = memoryview(data)
 
-# Read DRM files
+    drm = DrmIndex(view)
 
-    bs.seek(4)
-    entries = bs.readUInt()
-    data_start = (entries * 0x14) + 8
-    flag = 0
+    textures = ReadTextures(view, drm, noesis.optWasInvoked("-usedtextures"))
 
-    for a in range(entries):
-        bs.seek(a * 0x14 + 8)
-        size1 = bs.readUInt()
-        entry_type = bs.readUInt()
-        bs.readUByte()
-        item_entries = bs.readUShort()
-        bs.readUByte()
-        entry_id = bs.readUInt()
 
-        if entry_type == 0:
-            header2 = data_start + (item_entries * 8)
-            bs.seek(header2)
-            tr7aemesh_id = bs.readUInt()
+# Read DRM files
 
-            if tr7aemesh_id == 0x04c20453:						# mesh data found
-                DrawModel(bs, header2, tex_list, mat_list, mdlList)
-                flag = 1
-#				break							# enable this line to just display first model found
+    meshes = findDrmMeshes(view, drm)
 
-        data_start += size1 + (item_entries * 8)
+    for header2 in meshes:								# mesh data found
+        DrawModel(view, header2, textures, mdlList)
+#		break							# enable this line to just display first model found
 
 
-    if flag == 0:
+    if len(meshes) == 0:
         print("No meshes found")
         return 0
 
@@ -115,209 +142,413 @@ def bcLoadModel(data, mdlList):
 
 
 
-def ReadTextures(bs):
-    bs.seek(4)
-    entries = bs.readUInt()
-    data_start = (entries * 0x14) + 8
-
-    tex_list = []
-    mat_list = []
+# Entry table of an object DRM, decoded once and shared by the texture and mesh readers
 
-    for a in range(entries):
-        bs.seek(a * 0x14 + 8)
-        size1 = bs.readUInt()
-        entry_type = bs.readUInt()
-        bs.readUByte()
-        item_entries = bs.readUShort()
-        bs.readUByte()
-        entry_id = bs.readUInt()
+DRM_ENTRY_STRUCT = struct.Struct("<IIxHxI4x")
 
-        if entry_type == 5:												# PCD
-            material = NoeMaterial("Material_" + str(entry_id), "")
-            bs.seek(data_start + 4)
-            pcd_type = bs.readUInt()
-            pcd_size = bs.readUInt()
-            bs.readUInt()
-            width = bs.readUShort()
-            height = bs.readUShort()
+class DrmIndex:
+    sizes = None
+    types = None
+    itemEntries = None
+    ids = None
+    
+    # absolute offset of each entry, its relocations (8 bytes per item) come before the data
+    offsets = None
+    
+    def __init__(self, data):
+        view = memoryview(data)
+        entries = struct.unpack_from("<I", view, 4)[0]
+        data_start = (entries * 0x14) + 8
+        
+        self.sizes = []
+        self.types = []
+        self.itemEntries = []
+        self.ids = []
+        
+        for size, type, item_entries, id in DRM_ENTRY_STRUCT.iter_unpack(view[8:data_start]):
+            self.sizes.append(size)
+            self.types.append(type)
+            self.itemEntries.append(item_entries)
+            self.ids.append(id)
+        
+        lengths = [size + (item_entries * 8) for size, item_entries in zip(self.sizes, self.itemEntries)]
+        self.offsets = list(itertools.accumulate([data_start] + lengths[:-1]))[:entries]
+    
+    # indices of all entries of the given type
+    def byType(self, type):
+        return [i for i, entry_type in enumerate(self.types) if entry_type == type]
 
-            bs.seek(data_start + 0x18)
-            raw_data = bs.readBytes(pcd_size)
+# offsets of the tr7aemesh models in the entries of a DRM
 
-            if pcd_type == 0x15:										# RGBA32
-                tex1 = NoeTexture("Texture_" + str(entry_id) + ".tga", width, height, raw_data, noesis.NOESISTEX_RGBA32)
+def findDrmMeshes(view, drm):
+    meshes = []
 
-            elif pcd_type == 0x31545844:										# DXT1
-                tex1 = NoeTexture("Texture_" + str(entry_id) + ".tga", width, height, raw_data, noesis.NOESISTEX_DXT1)
+    for a in drm.byType(0):
+        header2 = drm.offsets[a] + (drm.itemEntries[a] * 8)
 
-            elif pcd_type == 0x35545844:										# DXT5
-                tex1 = NoeTexture("Texture_" + str(entry_id) + ".tga", width, height, raw_data, noesis.NOESISTEX_DXT5)
+        if struct.unpack_from("<I", view, header2)[0] == MESH_MAGIC:
+            meshes.append(header2)
 
-            else:
-                print("Texture format ", hex(pcd_type), " unknown")
+    return meshes
 
-            material.setTexture("Texture_" + str(entry_id))
-            tex_list.append(tex1)
-            mat_list.append(material)
+# Textures of a DRM, decoded the first time a mesh requests them. Unless only the used
+# textures are wanted everything is requested upfront, in file order, like before
 
-        data_start += size1 + (item_entries * 8)
+class TextureLoader:
+    textures = None
+    materials = None
+    pending = None
+    
+    def __init__(self):
+        self.textures = []
+        self.materials = []
+        self.pending = {}
+    
+    # decode returns a (texture, material) tuple, or None if the format is not supported
+    def add(self, id, decode):
+        self.pending[id] = decode
+    
+    def request(self, id):
+        decode = self.pending.pop(id, None)
+        if decode == None:
+            return
+        
+        result = decode()
+        if result != None:
+            self.textures.append(result[0])
+            self.materials.append(result[1])
+    
+    def requestAll(self):
+        for id in list(self.pending):
+            self.request(id)
 
-    return tex_list, mat_list
+def ReadTextures(view, drm, usedOnly = False):
+    textures = TextureLoader()
 
+    for a in drm.byType(5):												# PCD
+        textures.add(drm.ids[a], lambda a = a: ReadTexture(view, drm, a))
 
-# Draw one complete model
+    if not usedOnly:
+        textures.requestAll()
 
-def DrawModel(bs, header2, tex_list, mat_list, mdlList):
-    ctx = rapi.rpgCreateContext()
-    bs.seek(header2)
-    file_id = bs.readUInt()
+    return textures
 
-    bone_count1 = bs.readUInt()
-    bone_count2 = bs.readUInt()
-    bone_data = bs.readUInt() + header2
-    scaleX = bs.readFloat()
-    scaleY = bs.readFloat()
-    scaleZ = bs.readFloat()
+def ReadTexture(view, drm, a):
+    entry_id = drm.ids[a]
+    texture = readPCD(view, drm.offsets[a])
+    format = getNoeTextureFormat(texture.format)
 
+    if format == None:
+        print("Texture format ", hex(texture.format), " unknown")
+        return None
 
-# Read skeleton data
+    material = NoeMaterial("Material_" + str(entry_id), "")
+    tex1 = NoeTexture("Texture_" + str(entry_id) + ".tga", texture.width, texture.height, bytes(texture.data), format)
 
-    bones = []
-    bonesM = []
-
-    for a in range(bone_count1):
-        bs.seek(bone_data + (a * 0x40) + 0x20)
-
-        pos = NoeVec3.fromBytes(bs.readBytes(12))
-        bs.seek(12, NOESEEK_REL)
-        boneParent = bs.readUInt()
-
-        # Read HInfo data
-
-        HInfo = bs.readUInt()
-        if HInfo != 0:
-
-            bs.seek(HInfo + header2)
-            numHSpheres = bs.readInt()
-            hsphereList = bs.readUInt()
-            numHBoxes = bs.readInt()
-            hboxList = bs.readUInt()
-            numHMarkers = bs.readInt()
-            hmarkerList = bs.readUInt()
-            numHCapsules = bs.readInt()
-            hcapsuleList = bs.readUInt()
-
-            print("\nHInfo detected for bone%03i"%a + "\nHSpheres = " + str(numHSpheres) + "\nHBoxes = " + str(numHBoxes) + "\nHMarkers = " + str(numHMarkers) + "\nHCapsules = " + str(numHCapsules))
-
-            if numHSpheres > 0:
-                bs.seek (hsphereList + header2)
-                flags = bs.readShort()
-                id = bs.readByte()
-                rank = bs.readByte()
-                radius = bs.readShort()
-                X = bs.readShort()
-                Y = bs.readShort()
-                Z = bs.readShort()
-                radiusSquares = bs.readUInt()
-                mass = bs.readUInt()
-                buoyancyFactor = bs.readByte()
-                explosionFactor = bs.readByte()
-                iHitMaterialType = bs.readByte()
-                pad = bs.readByte()
-                damage = bs.readShort()
-
-            if numHMarkers > 0:
-                bs.seek (hmarkerList + header2)
-                for b in range(numHMarkers):
-                    bone = bs.readInt()
-                    index = bs.readInt()
-                    posMarker = NoeVec3.fromBytes(bs.readBytes(12))
-                    rx = bs.readFloat()
-                    ry = bs.readFloat()
-                    rz = bs.readFloat()
-                    matrixMarker = NoeQuat([0, 0, 0, 1]).toMat43()   
-                    matrixMarker[3] = posMarker
-                    if not a:
-                        matrixMarker *= NoeAngles([90,0,0]).toMat43()
-
-                        bonesM.append(NoeBone(a, "Marker%03i"%a, matrixMarker, None, bone))
-
-                    print("posMarker being " + str(posMarker))
+    material.setTexture("Texture_" + str(entry_id))
 
-        matrix = NoeQuat([0, 0, 0, 1]).toMat43()
-        matrix[3] = pos
-        if not a:
-            matrix *= NoeAngles([90,0,0]).toMat43()
+    return tex1, material
 
-        bones.append(NoeBone(a, "bone%03i"%a, matrix, None, boneParent))
 
-    bones = rapi.multiplyBones(bones)
-    bonesM = rapi.multiplyBones(bones)
+# Vertex layout shared by DRM meshes and tr7aemesh files (0x10 bytes):
+# position (3 shorts), normal (3 bytes), padding byte, bone id, uv (2 ushorts, upper half of a float)
 
+VERTEX_STRUCT = struct.Struct("<3h3bxH2H")
 
-# Read vertex data
+def readVertexBlock(data, vert_start, vert_count, scale):
+    if vert_count == 0:
+        return [], [], (), bytearray()
 
-    bs.seek(header2 + 0x20)
-    vert_count = bs.readUInt()
-    vert_start = bs.readUInt() + header2
+    # decode the whole block at once instead of reading it field by field
+    block = memoryview(data)[vert_start:vert_start + (vert_count * 0x10)]
+    vx, vy, vz, nx, ny, nz, bone_ids, uvx, uvy = zip(*VERTEX_STRUCT.iter_unpack(block))
+    scaleX, scaleY, scaleZ = scale
 
-    bs.seek(header2 + 0x58)
-    face_info = bs.readUInt() + header2
+    positions = list(zip([x * scaleX for x in vx], [y * scaleY for y in vy], [z * scaleZ for z in vz]))
+    normals = list(zip([x / 127 for x in nx], [y / 127 for y in ny], [z / 127 for z in nz]))
 
-    vertices = bytearray(vert_count * 12)
+    # uvs only store the upper 16 bits of each float, so copy them straight into a float buffer
     uvs = bytearray(vert_count * 8)
-    normals = bytearray(vert_count * 12)
-    bone_idx = bytearray(vert_count * 4)
-    weights = bytearray(vert_count * 8)
-
-    bs.seek(vert_start)
-
-    for v in range(vert_count):
-        bs.seek(vert_start + (v * 0x10))
-        vx = bs.readShort() * scaleX
-        vy = bs.readShort() * scaleY
-        vz = bs.readShort() * scaleZ
-
-        nx = bs.readByte() / 127
-        ny = bs.readByte() / 127
-        nz = bs.readByte() / 127
-        bs.readByte()								# padding byte
-
-        bone_id = bs.readUShort()
-        uvx = bs.readUShort() << 16							# convert to correct float value
-        uvy = bs.readUShort() << 16
-
-        if bone_id > (bone_count1-1):
-            bs.seek(bone_data + (bone_id * 0x40) + 0x38)
-            bone_id = bs.readUShort()
-            bone_id2 = bs.readUShort()
-            weight1 = bs.readFloat()
-            weight2 = 1 - weight1
-            struct.pack_into("<HH", bone_idx, v * 4, bone_id, bone_id2)
-            struct.pack_into("<ff", weights, v * 8, weight2, weight1)
-        else:
-            struct.pack_into("<HH", bone_idx, v * 4, bone_id, 0)
-            struct.pack_into("<ff", weights, v * 8, 1, 0)
+    uvs[2::8] = block[12::16]
+    uvs[3::8] = block[13::16]
+    uvs[6::8] = block[14::16]
+    uvs[7::8] = block[15::16]
 
-# Transform vertices to bone position without using rpgSkinPreconstructedVertsToBones
+    return positions, normals, bone_ids, uvs
 
-        vertpos = bones[bone_id].getMatrix().transformPoint([vx, vy, vz])
-        vx = vertpos[0]
-        vy = vertpos[1]
-        vz = vertpos[2]
-        
-        norm = bones[bone_id].getMatrix().transformNormal([nx, ny, nz])
-        nx = norm[0]
-        ny = norm[1]
-        nz = norm[2]
+def packVec3List(vecs):
+    return struct.pack("<%df" % (len(vecs) * 3), *[c for vec in vecs for c in (vec[0], vec[1], vec[2])])
+
+# World matrices of all bones as plain (N, 4, 3) tuples, so they are only built once per model
+
+def getBoneMatrices(bones):
+    matrices = []
+    for bone in bones:
+        mat = bone.getMatrix()
+        matrices.append(tuple((mat[r][0], mat[r][1], mat[r][2]) for r in range(4)))
+
+    return matrices
+
+# The same world matrices worked out without Noesis. Bones only have a position and the
+# root is pitched 90 degrees, so every bone has the root rotation and its translation is
+# the sum of the positions up the hierarchy, rotated
+
+ROOT_ROTATION = ((1.0, 0.0, 0.0), (0.0, 0.0, 1.0), (0.0, -1.0, 0.0))
+
+def getBindMatrices(bones):
+    (r00, r01, r02), (r10, r11, r12), (r20, r21, r22) = ROOT_ROTATION
+    sums = {}
+
+    def getSum(a):
+        if a not in sums:
+            x, y, z = bones[a].pos
+            parent = bones[a].parent
+
+            sums[a] = (x, y, z)
+            if parent < len(bones) and parent != a:
+                px, py, pz = getSum(parent)
+                sums[a] = (x + px, y + py, z + pz)
+
+        return sums[a]
+
+    matrices = []
+    for a in range(len(bones)):
+        x, y, z = getSum(a)
+        matrices.append((ROOT_ROTATION[0], ROOT_ROTATION[1], ROOT_ROTATION[2], (x * r00 + y * r10 + z * r20, x * r01 + y * r11 + z * r21, x * r02 + y * r12 + z * r22)))
+
+    return matrices
+
+# Transform vertices to bone position without using rpgSkinPreconstructedVertsToBones.
+# Vertices are grouped by bone so every group is transformed with one unpacked matrix
+
+def transformVertexGroups(positions, normals, skin_bones, matrices):
+    groups = {}
+    for v, bone_id in enumerate(skin_bones):
+        groups.setdefault(bone_id, []).append(v)
+
+    for bone_id, group in groups.items():
+        (m00, m01, m02), (m10, m11, m12), (m20, m21, m22), (m30, m31, m32) = matrices[bone_id]
+
+        for v in group:
+            x, y, z = positions[v]
+            positions[v] = (x * m00 + y * m10 + z * m20 + m30, x * m01 + y * m11 + z * m21 + m31, x * m02 + y * m12 + z * m22 + m32)
+            x, y, z = normals[v]
+            normals[v] = (x * m00 + y * m10 + z * m20, x * m01 + y * m11 + z * m21, x * m02 + y * m12 + z * m22)
+
+# Skin lookup table indexed by a vertex bone id. Ids below bone_count1 are rigid bones,
+# the rest are VirtSegments which blend between index and weightIndex
+
+VIRTSEGMENT_STRUCT = struct.Struct("<HHf")
+
+def readSkinTable(data, bone_data, bone_count1, bone_count2, max_bone_id):
+    count = max(bone_count2, max_bone_id + 1)
+
+    index_table = list(range(count))
+    weight_index_table = [0] * count
+    weight_table = [0.0] * count
+
+    for bone_id in range(bone_count1, count):
+        index, weight_index, weight = VIRTSEGMENT_STRUCT.unpack_from(data, bone_data + (bone_id * 0x40) + 0x38)
+        index_table[bone_id] = index
+        weight_index_table[bone_id] = weight_index
+        weight_table[bone_id] = weight
+
+    return index_table, weight_index_table, weight_table
+
+def readMeshVertices(data, vert_start, vert_count, bone_count1, bone_count2, bone_data, scale, matrices):
+    positions, normals, bone_ids, uvs = readVertexBlock(data, vert_start, vert_count, scale)
+
+    if vert_count == 0:
+        return bytearray(), bytearray(), uvs, bytearray(), bytearray()
+
+    index_table, weight_index_table, weight_table = readSkinTable(data, bone_data, bone_count1, bone_count2, max(bone_ids))
+
+    skin_bones = [index_table[b] for b in bone_ids]
+    skin_weights = [weight_table[b] for b in bone_ids]
+
+    bone_idx = struct.pack("<%dH" % (vert_count * 2), *[i for b in bone_ids for i in (index_table[b], weight_index_table[b])])
+    weights = struct.pack("<%df" % (vert_count * 2), *[w for weight in skin_weights for w in (1 - weight, weight)])
+
+    transformVertexGroups(positions, normals, skin_bones, matrices)
+
+    return packVec3List(positions), packVec3List(normals), uvs, bone_idx, weights
+
+
+# tr7aemesh model, at the same place in DRM mesh entries and after the section header of
+# .tr7aemesh files. Offsets in the model are relative to its start (header2)
+
+MESH_MAGIC = 0x04c20453
+
+MESH_HEADER_STRUCT = struct.Struct("<4xIII3f")
+MESH_BONE_STRUCT = struct.Struct("<3f4xI4xII")
+HINFO_STRUCT = struct.Struct("<iIiIiIiI")
+HSPHERE_STRUCT = struct.Struct("<hbbhhhhIIbbbbh")
+HMARKER_STRUCT = struct.Struct("<ii3f3f")
+SUBMESH_STRUCT = struct.Struct("<HHiffI")
+
+class MeshData:
+    view = None
+    boneCount1 = None
+    boneCount2 = None
+    boneData = None
+    scale = None
+    bones = None
+    vertCount = None
+    vertStart = None
+    subMeshes = None
+
+    # (vertices, normals, uvs, bone indices, weights) buffers, skinned with the given bone matrices
+    def getVertexBuffers(self, matrices):
+        return readMeshVertices(self.view, self.vertStart, self.vertCount, self.boneCount1, self.boneCount2, self.boneData, self.scale, matrices)
+
+class MeshBone:
+    pos = None
+    flags = None
+    parent = None
+    hinfo = None
+
+    def __init__(self, pos, flags, parent, hinfo):
+        self.pos = pos
+        self.flags = flags
+        self.parent = parent
+        self.hinfo = hinfo
+
+class HInfo:
+    numHSpheres = None
+    numHBoxes = None
+    numHMarkers = None
+    numHCapsules = None
+
+    # (X, Y, Z) of each HSphere
+    spheres = None
+
+    # (bone, index, position) of each HMarker
+    markers = None
+
+class SubMesh:
+    faceCount = None
+    drawGroup = None
+    tpageid = None
+    sortPush = None
+    scrollOffset = None
+    faces = None
+
+    # bits of tpageid
+    textureId = None
+    blendValue = None
+    singleSided = None
+
+    def __init__(self, faceCount, drawGroup, tpageid, sortPush, scrollOffset, faces):
+        self.faceCount = faceCount
+        self.drawGroup = drawGroup
+        self.tpageid = tpageid
+        self.sortPush = sortPush
+        self.scrollOffset = scrollOffset
+        self.faces = faces
+
+        self.textureId = tpageid & 0x1FFF						# bits 0-12
+        self.blendValue = (tpageid >> 13) & 0xF
+        self.singleSided = (tpageid >> 21) & 1
+
+# offset of the model in a .tr7aemesh file, after the section header and its relocations
+
+def getMeshFileOffset(view):
+    header1_count = view[0x0d]					# or Short?
+    return (header1_count * 0x8) + 0x18					# 0x5304c204
+
+def readMesh(view, header2):
+    mesh = MeshData()
+    mesh.view = view
+
+    mesh.boneCount1, mesh.boneCount2, boneData, scaleX, scaleY, scaleZ = MESH_HEADER_STRUCT.unpack_from(view, header2)
+    mesh.boneData = boneData + header2
+    mesh.scale = (scaleX, scaleY, scaleZ)
+
+    # skeleton
+    mesh.bones = []
+
+    for a in range(mesh.boneCount1):
+        x, y, z, flags, boneParent, hinfo = MESH_BONE_STRUCT.unpack_from(view, mesh.boneData + (a * 0x40) + 0x20)
+        mesh.bones.append(MeshBone((x, y, z), flags, boneParent, readHInfo(view, header2, hinfo + header2) if hinfo != 0 else None))
+
+    # vertices and faces
+    mesh.vertCount, vert_start = struct.unpack_from("<II", view, header2 + 0x20)
+    mesh.vertStart = vert_start + header2
+
+    face_info = struct.unpack_from("<I", view, header2 + 0x58)[0] + header2
+    mesh.subMeshes = readSubMeshes(view, header2, face_info)
+
+    return mesh
+
+def readHInfo(view, header2, offset):
+    hinfo = HInfo()
+    hinfo.numHSpheres, hsphereList, hinfo.numHBoxes, hboxList, hinfo.numHMarkers, hmarkerList, hinfo.numHCapsules, hcapsuleList = HINFO_STRUCT.unpack_from(view, offset)
+
+    hinfo.spheres = []
+    for b in range(max(0, hinfo.numHSpheres)):
+        sphere = HSPHERE_STRUCT.unpack_from(view, header2 + hsphereList + (b * HSPHERE_STRUCT.size))
+        hinfo.spheres.append(sphere[4:7])
+
+    hinfo.markers = []
+    for c in range(max(0, hinfo.numHMarkers)):
+        marker = HMARKER_STRUCT.unpack_from(view, header2 + hmarkerList + (c * HMARKER_STRUCT.size))
+        hinfo.markers.append((marker[0], marker[1], marker[2:5]))
 
-        struct.pack_into("<fff", vertices, v * 12, vx, vy, vz)
-        struct.pack_into("<II", uvs, v*8, uvx, uvy)
-        struct.pack_into("<fff", normals, v*12, nx, ny, nz)
+    return hinfo
 
-    flag = 0
-    current_mesh = face_info
-    mesh_num = 0
+# sub meshes follow each other through their next offset until one has no faces
+
+def readSubMeshes(view, header2, current_mesh):
+    subMeshes = []
+
+    while True:
+        face_count = struct.unpack_from("<H", view, current_mesh)[0]
+
+        if face_count == 0:								# no more sub-meshes
+            break
+
+        face_count, drawgroup, tpageid, sortPush, scrollOffset, next_mesh = SUBMESH_STRUCT.unpack_from(view, current_mesh)
+        faces = view[current_mesh + SUBMESH_STRUCT.size:current_mesh + SUBMESH_STRUCT.size + (face_count * 2)]
+
+        subMeshes.append(SubMesh(face_count, drawgroup, tpageid, sortPush, scrollOffset, faces))
+        current_mesh = next_mesh + header2					# next face section
+
+    return subMeshes
+
+# Noesis bones of a model, HInfo is only printed. HSpheres and HMarkers are numbered across
+# the whole model
+
+def buildBones(mesh):
+    bones = []
+    hsphere_num = 0
+    hmarker_num = 0
+
+    for a, bone in enumerate(mesh.bones):
+        if bone.hinfo != None:
+            printHInfo(a, bone.hinfo, hsphere_num, hmarker_num)
+            hsphere_num += len(bone.hinfo.spheres)
+            hmarker_num += len(bone.hinfo.markers)
+
+        matrix = NoeQuat([0, 0, 0, 1]).toMat43()
+        matrix[3] = NoeVec3(bone.pos)
+        if not a:
+            matrix *= NoeAngles([90,0,0]).toMat43()
+
+        bones.append(NoeBone(a, "bone%03i"%a, matrix, None, bone.parent))
+
+    return rapi.multiplyBones(bones)
+
+def printHInfo(a, hinfo, hsphere_num = 0, hmarker_num = 0):
+    print("\nHInfo detected for bone%03i"%a + "\nHSpheres = " + str(hinfo.numHSpheres) + "\nHBoxes = " + str(hinfo.numHBoxes) + "\nHMarkers = " + str(hinfo.numHMarkers) + "\nHCapsules = " + str(hinfo.numHCapsules))
+
+    for b, sphere in enumerate(hinfo.spheres, hsphere_num):
+        print("HSphere {} ".format(b) + str(sphere))
+
+    for c, (bone, index, posMarker) in enumerate(hinfo.markers, hmarker_num):
+        print("HMarker {} ".format(c) + str(NoeVec3(posMarker)))
+
+def bindMeshVertices(mesh, bones):
+    vertices, normals, uvs, bone_idx, weights = mesh.getVertexBuffers(getBoneMatrices(bones))
 
     rapi.rpgBindPositionBuffer(vertices, noesis.RPGEODATA_FLOAT, 12)
     rapi.rpgBindNormalBuffer(normals, noesis.RPGEODATA_FLOAT, 12)
@@ -325,46 +556,33 @@ def DrawModel(bs, header2, tex_list, mat_list, mdlList):
     rapi.rpgBindBoneIndexBuffer(bone_idx, noesis.RPGEODATA_USHORT, 4, 2)
     rapi.rpgBindBoneWeightBuffer(weights, noesis.RPGEODATA_FLOAT, 8, 2)
 
-    while flag == 0:
-        bs.seek(current_mesh)
-        face_count = bs.readUShort()
+def getSubMeshName(mesh_num, subMesh):
+    return "Mesh_" + str(mesh_num) + "_TexID_" + str(subMesh.textureId) + "_Blend_" + str(subMesh.blendValue) + "_SingleSided_" + str(subMesh.singleSided) + "_dg_" + str(subMesh.drawGroup)
 
-        if face_count == 0:								# no more sub-meshes
-            break
 
-        drawgroup = bs.readUShort()
-        texidoffset = bs.tell()
-        tex_id = bs.readUShort() & 0x1FFF						# bits 0-12
-        misc3 = bs.readUShort()
-        sortPush = bs.readFloat()
-        scrollOffset = bs.readFloat()
-        
-        bs.seek(texidoffset)
-        texture_id = bs.readBits(13)
-        blendValue = bs.readBits(4)
-        unk1 = bs.readBits(4)
-        SingleSided = bs.readBits(1)
-        unk2 = bs.readBits(10)
-        
-        bs.seek(texidoffset)
-        tpageid = bs.readInt()
-        sortPush = bs.readFloat()
-        scrollOffset = bs.readFloat()
-        
-        current_mesh = bs.readUInt() + header2					# next face section
-        faces = bs.readBytes(face_count * 2)
-        
+# Draw one complete model
+
+def DrawModel(view, header2, textures, mdlList):
+    ctx = rapi.rpgCreateContext()
+    mesh = readMesh(view, header2)
+    bones = buildBones(mesh)
+
+    bindMeshVertices(mesh, bones)
+
+    for mesh_num, subMesh in enumerate(mesh.subMeshes):
+        tex_id = subMesh.textureId
+
+        textures.request(tex_id)
         rapi.rpgSetMaterial("Material_" + str(tex_id))
-        rapi.rpgSetName("Mesh_" + str(mesh_num) + "_TexID_" + str(texture_id) + "_Blend_" + str(blendValue) + "_SingleSided_" + str(SingleSided) + "_dg_" + str(drawgroup))
-        rapi.rpgCommitTriangles(faces, noesis.RPGEODATA_USHORT, face_count, noesis.RPGEO_TRIANGLE)
-        mesh_num += 1
+        rapi.rpgSetName(getSubMeshName(mesh_num, subMesh))
+        rapi.rpgCommitTriangles(bytes(subMesh.faces), noesis.RPGEODATA_USHORT, subMesh.faceCount, noesis.RPGEO_TRIANGLE)
 
     try:
         mdl = rapi.rpgConstructModel()
     except:
         mdl = NoeModel()
 
-    mdl.setModelMaterials(NoeModelMaterials(tex_list, mat_list))
+    mdl.setModelMaterials(NoeModelMaterials(textures.textures, textures.materials))
     mdl.setBones(bones)
     mdlList.append(mdl)
 
@@ -381,258 +599,98 @@ def bdCheckType(data):
         return 1
         
 def bdLoadModel(data, mdlList):
-    bs = NoeBitStream(data)
+    view = memoryview(data)
     ctx = rapi.rpgCreateContext()
 
-    bs.seek(0x0d)
-    header1_count = bs.readUByte()					# or Short?
-    header2 = (header1_count * 0x8) + 0x18					# 0x5304c204
-
-    bs.seek(header2 + 4)
-    bone_count1 = bs.readUInt()
-    bone_count2 = bs.readUInt()
-    bone_data = bs.readUInt() + header2
-    scaleX = bs.readFloat()
-    scaleY = bs.readFloat()
-    scaleZ = bs.readFloat()
-    bs.seek(header2 + 0x4c)
+    mesh = readMesh(view, getMeshFileOffset(view))
+    bones = buildBones(mesh)
 
+    bindMeshVertices(mesh, bones)
 
-# Read skeleton data
+    for mesh_num, subMesh in enumerate(mesh.subMeshes):
+        rapi.rpgSetMaterial("Material_" + str(subMesh.tpageid))
+        rapi.rpgSetName(getSubMeshName(mesh_num, subMesh))
+        rapi.rpgCommitTriangles(bytes(subMesh.faces), noesis.RPGEODATA_USHORT, subMesh.faceCount, noesis.RPGEO_TRIANGLE)
 
-    bones = []
-    secondBoneList = []
-    hmarker_num = 0
-    boneHMarker = 0
-    hsphere_num = 0
-
-    for a in range(bone_count1):
-        bs.seek(bone_data + (a * 0x40) + 0x20)
-
-        pos = NoeVec3.fromBytes(bs.readBytes(12))
-        bs.seek(4, NOESEEK_REL)
-        flags = bs.readUInt()
-        bs.seek(4, NOESEEK_REL)
-        boneParent = bs.readUInt()
-
-        # Read HInfo data
-
-        HInfo = bs.readUInt()
-        if HInfo != 0:
-
-            bs.seek(HInfo + header2)
-            numHSpheres = bs.readInt()
-            hsphereList = bs.readUInt()
-            numHBoxes = bs.readInt()
-            hboxList = bs.readUInt()
-            numHMarkers = bs.readInt()
-            hmarkerList = bs.readUInt()
-            numHCapsules = bs.readInt()
-            hcapsuleList = bs.readUInt()
-
-            print("\nHInfo detected for bone%03i"%a + "\nHSpheres = " + str(numHSpheres) + "\nHBoxes = " + str(numHBoxes) + "\nHMarkers = " + str(numHMarkers) + "\nHCapsules = " + str(numHCapsules))
-
-            if numHSpheres > 0:
-                bs.seek (hsphereList + header2)
-                for b in range(numHSpheres):
-                    flags = bs.readShort()
-                    id = bs.readByte()
-                    rank = bs.readByte()
-                    radius = bs.readShort()
-                    X = bs.readShort()
-                    Y = bs.readShort()
-                    Z = bs.readShort()
-                    radiusSquares = bs.readUInt()
-                    mass = bs.readUInt()
-                    buoyancyFactor = bs.readByte()
-                    explosionFactor = bs.readByte()
-                    iHitMaterialType = bs.readByte()
-                    pad = bs.readByte()
-                    damage = bs.readShort()
-
-                    print("HSphere {} ".format(hsphere_num) + str((X, Y, Z)))
-
-                    hsphere_num += 1
-
-            if numHMarkers > 0:
-                bs.seek (hmarkerList + header2)
-                for c in range(numHMarkers):
-                    bone = bs.readInt()
-                    index = bs.readInt()
-                    posMarker = NoeVec3.fromBytes(bs.readBytes(12))
-                    rx = bs.readFloat()
-                    ry = bs.readFloat()
-                    rz = bs.readFloat()
-                    matrixMarker = NoeQuat([0, 0, 0, 1]).toMat43()   
-                    matrixMarker[3] = posMarker
-                    if not c:
-                        matrixMarker *= NoeAngles([90,0,0]).toMat43()
-
-                    secondBoneList.append(NoeBone(c, "HMarker_{}_bone_{}_index_{}".format(hmarker_num, boneHMarker, index), matrixMarker, None, bone))
-
-                    print("HMarker {} ".format(hmarker_num) + str(posMarker))
-                    # bones.extend(secondBoneList)
-                    # for i, bone in enumerate(bones):
-                      # bone.index = i
-
-                    hmarker_num += 1
-        boneHMarker += 1
+    try:
+        mdl = rapi.rpgConstructModel()
+    except:
+        mdl = NoeModel()
 
-        matrix = NoeQuat([0, 0, 0, 1]).toMat43()
-        matrix[3] = pos
-        if not a:
-            matrix *= NoeAngles([90,0,0]).toMat43()
+    mdl.setBones(bones)
+    mdlList.append(mdl)
 
-        bones.append(NoeBone(a, "bone%03i"%a, matrix, None, boneParent))
+    return 1
 
-    bones = rapi.multiplyBones(bones)
 
+# Texture headers. data is a view of the pixel or DXT block data in the file, mipmaps included
 
-# Read vertex data
+PCD_FORMAT_DXT1 = 0x31545844
+PCD_FORMAT_DXT5 = 0x35545844
+PCD_FORMAT_RGBA32 = 0x15
 
-    bs.seek(header2 + 0x20)
-    vert_count = bs.readInt()
-    vert_start = bs.readInt() + header2
+# PS3 textures have a big endian PS3T header followed by a CellGcmTexture
 
-    bs.seek(header2 + 0x58)
-    face_info = bs.readUInt() + header2
+PS3T_MAGIC = 0x54335350
 
-    vertices = bytearray(vert_count * 12)
-    uvs = bytearray(vert_count * 8)
-    normals = bytearray(vert_count * 12)
+PS3_TEXTURE_DXT1 = 0x86
+PS3_TEXTURE_DXT5 = 0x88
 
-    bs.seek(vert_start)
-    bone_idx = bytearray(vert_count * 8)
-    bone_wgt = bytearray(vert_count * 16)
+PS3_TEXTURE_FORMATS = {PS3_TEXTURE_DXT1: PCD_FORMAT_DXT1, PS3_TEXTURE_DXT5: PCD_FORMAT_DXT5, 0x15: PCD_FORMAT_RGBA32}
 
-    bs.seek(header2 + 0x20)
-    vert_count = bs.readUInt()
-    vert_start = bs.readUInt() + header2
+class TextureData:
+    format = None
+    width = None
+    height = None
+    mipCount = None
+    data = None
 
-    bs.seek(header2 + 0x58)
-    face_info = bs.readUInt() + header2
+    # channel order of raw textures, as rapi.imageDecodeRaw takes it
+    pixelFormat = None
 
-    vertices = bytearray(vert_count * 12)
-    uvs = bytearray(vert_count * 8)
-    normals = bytearray(vert_count * 12)
-    bone_idx = bytearray(vert_count * 4)
-    weights = bytearray(vert_count * 8)
-
-    bs.seek(vert_start)
-
-    for v in range(vert_count):
-        bs.seek(vert_start + (v * 0x10))
-        vx = bs.readShort() * scaleX
-        vy = bs.readShort() * scaleY
-        vz = bs.readShort() * scaleZ
-
-        nx = bs.readByte() / 127
-        ny = bs.readByte() / 127
-        nz = bs.readByte() / 127
-        bs.readByte()								# padding byte
-
-        bone_id = bs.readUShort()
-        uvx = bs.readUShort() << 16							# convert to correct float value
-        uvy = bs.readUShort() << 16
-
-        if bone_id > (bone_count1-1):
-            bs.seek(bone_data + (bone_id * 0x40) + 0x38)
-            bone_id = bs.readUShort()
-            bone_id2 = bs.readUShort()
-            weight1 = bs.readFloat()
-            weight2 = 1 - weight1
-            struct.pack_into("<HH", bone_idx, v * 4, bone_id, bone_id2)
-            struct.pack_into("<ff", weights, v * 8, weight2, weight1)
-        else:
-            struct.pack_into("<HH", bone_idx, v * 4, bone_id, 0)
-            struct.pack_into("<ff", weights, v * 8, 1, 0)
+    def __init__(self, format, width, height, mipCount, data, pixelFormat = None):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.mipCount = mipCount
+        self.data = data
+        self.pixelFormat = pixelFormat
 
+# PCD9 header at offset, 0x18 in .pcd files and at the start of DRM texture sections
 
-# Transform vertices to bone position without using rpgSkinPreconstructedVertsToBones
+def readPCD(view, offset):
+    format, size, width, height, mipCount = struct.unpack_from("<4xII4xHHxB", view, offset)
 
-        vertpos = bones[bone_id].getMatrix().transformPoint([vx, vy, vz])
-        vx = vertpos[0]
-        vy = vertpos[1]
-        vz = vertpos[2]
-        
-        norm = bones[bone_id].getMatrix().transformNormal([nx, ny, nz])
-        nx = norm[0]
-        ny = norm[1]
-        nz = norm[2]
+    return TextureData(format, width, height, mipCount, view[offset + 0x18:offset + 0x18 + size])
 
-        struct.pack_into("<fff", vertices, v * 12, vx, vy, vz)
-        struct.pack_into("<II", uvs, v*8, uvx, uvy)
-        struct.pack_into("<fff", normals, v*12, nx, ny, nz)
+# PS3T header at offset, formats are translated to the PC ones
 
-    flag = 0
-    current_mesh = face_info
-    mesh_num = 0
+def readPS3PCD(view, offset):
+    size, format, mipCount, width, height = struct.unpack_from(">4xI4xBB6xHH", view, offset)
 
-    rapi.rpgBindPositionBuffer(vertices, noesis.RPGEODATA_FLOAT, 12)
-    rapi.rpgBindNormalBuffer(normals, noesis.RPGEODATA_FLOAT, 12)
-    rapi.rpgBindUV1Buffer(uvs, noesis.RPGEODATA_FLOAT, 8)
-    rapi.rpgBindBoneIndexBuffer(bone_idx, noesis.RPGEODATA_USHORT, 4, 2)
-    rapi.rpgBindBoneWeightBuffer(weights, noesis.RPGEODATA_FLOAT, 8, 2)
+    return TextureData(PS3_TEXTURE_FORMATS.get(format, format), width, height, max(0, mipCount - 1), view[offset + 0x24:offset + 0x24 + size])
 
-    while flag == 0:
-        bs.seek(current_mesh)
-        face_count = bs.readUShort()
+def readRaw(view):
+    size, width, height = struct.unpack_from("<8xI8xii", view, 0)
 
-        if face_count == 0:								# no more sub-meshes
-            break
+    return TextureData(None, width, height, 0, view[0x80:0x80 + size], "b8g8r8a8")
 
-        drawgroup = bs.readUShort()
-        texidoffset = bs.tell()
-        tex_id = bs.readUShort() & 0x1FFF						# bits 0-12
-        misc3 = bs.readUShort()
-        sortPush = bs.readFloat()
-        scrollOffset = bs.readFloat()
-        
-        bs.seek(texidoffset)
-        texture_id = bs.readBits(13)
-        blendValue = bs.readBits(4)
-        unk1 = bs.readBits(4)
-        SingleSided = bs.readBits(1)
-        unk2 = bs.readBits(10)
-        
-        bs.seek(texidoffset)
-        tpageid = bs.readInt()
-        sortPush = bs.readFloat()
-        scrollOffset = bs.readFloat()
-        
-        current_mesh = bs.readUInt() + header2					# next face section
-        faces = bs.readBytes(face_count * 2)
-        
-        rapi.rpgSetMaterial("Material_" + str(tpageid))
-        rapi.rpgSetName("Mesh_" + str(mesh_num) + "_TexID_" + str(texture_id) + "_Blend_" + str(blendValue) + "_SingleSided_" + str(SingleSided) + "_dg_" + str(drawgroup))
-        rapi.rpgCommitTriangles(faces, noesis.RPGEODATA_USHORT, face_count, noesis.RPGEO_TRIANGLE)
-        mesh_num += 1
-
-# Read MFace data
-
-    bs.seek(header2 + 0x30)
-    numFaces = bs.readInt()
-    faceList = bs.readInt() + header2
-    for f in range(numFaces):
-        if faceList > 0:
-            bs.seek(faceList)
-            f0 = bs.readShort()
-            f1 = bs.readShort()
-            f2 = bs.readShort()
-            sameVertBits1 = bs.readBits(5)
-            sameVertBits2 = bs.readBits(5)
-            sameVertBits3 = bs.readBits(5)
+# PS3 raw textures are big endian and twiddled, the top level is untwiddled
 
-    try:
-        mdl = rapi.rpgConstructModel()
-    except:
-        mdl = NoeModel()
+def readPS3Raw(view):
+    size, width, height = struct.unpack_from(">8xI8xii", view, 0)
 
-    mdl.setBones(bones)
-    mdlList.append(mdl)
+    return TextureData(None, width, height, 0, untwiddle32(view[0x80:0x80 + size], width, height), "a8r8g8b8")
 
-    return 1
+def getNoeTextureFormat(format):
+    if format == PCD_FORMAT_DXT1:
+        return noesis.NOESISTEX_DXT1
+    elif format == PCD_FORMAT_DXT5:
+        return noesis.NOESISTEX_DXT5
+    elif format == PCD_FORMAT_RGBA32:
+        return noesis.NOESISTEX_RGBA32
 
+    return None
 
 def pcdCheckType(data):
     bs = NoeBitStream(data)
@@ -649,159 +707,285 @@ def pcdCheckType(data):
         return 1
 
 def pcdLoadDDS(data, texList):
-    bs = NoeBitStream(data)
-    bs.seek(0x18, NOESEEK_ABS)
-    magic = bs.readUInt()
+    view = memoryview(data)
     
-    if magic == 0x54335350: # PS3T
+    if struct.unpack_from("<I", view, 0x18)[0] == PS3T_MAGIC:
         return ps3pcdLoadDDS(data, texList)
-            
-    ddsType = bs.readUInt()
-    ddsSize = bs.readUInt()
-    bs.seek(0x4, NOESEEK_REL)
-    ddsWidth = bs.readUShort()
-    ddsHeight = bs.readUShort()
-    ddsFlags = bs.readByte()
-    ddsMipCount = bs.readByte()
-    ddsType2 = bs.readUShort()
-    ddsData = bs.readBytes(ddsSize)
-    ddsFmt = None
-    if ddsType == 0x31545844:
-        ddsFmt = noesis.NOESISTEX_DXT1
-    elif ddsType == 0x35545844:
-        ddsFmt = noesis.NOESISTEX_DXT5
-    elif ddsType == 0x15:
-        ddsData = rapi.imageDecodeRaw(ddsData, ddsWidth, ddsHeight, "a8a8a8a8")
-        ddsFmt = noesis.NOESISTEX_RGBA32
-    else: 
-        print("Fatal Error: " + "Unknown DDS type: " + str(hex(ddsType)) + " using default DXT1")
-    texList.append(NoeTexture("Texture", ddsWidth, ddsHeight, ddsData, ddsFmt))
+    
+    return appendPCDTexture(readPCD(view, 0x18), texList)
+
+def appendPCDTexture(texture, texList):
+    ddsData = texture.data
+    ddsFmt = getNoeTextureFormat(texture.format)
+    if texture.format == PCD_FORMAT_RGBA32:
+        ddsData = rapi.imageDecodeRaw(bytes(ddsData), texture.width, texture.height, "a8a8a8a8")
+    elif ddsFmt == None:
+        print("Fatal Error: " + "Unknown DDS type: " + str(hex(texture.format)) + " using default DXT1")
+    texList.append(NoeTexture("Texture", texture.width, texture.height, bytes(ddsData), ddsFmt))
     return 1
 
-def pcdWriteRGBA(data, width, height, bs):
-    filename = rapi.getOutputName()
-    oldDDS = rapi.loadIntoByteArray(rapi.getInputName())
-    og = NoeBitStream(oldDDS)
-    fsize = os.path.getsize(rapi.getInputName()) - 128
+# Mipmaps for the texture writers. Every level is built from the previous one instead of
+# the full size image: "box" averages 2x2 pixel blocks, "resample" uses Noesis' resampler
 
-    # Check if input file is a DDS file
-    ddsMagic = og.readUInt()
-    if ddsMagic != 542327876:
-            print ("\nInput file is not a DDS file!\nAborting...\n")
-            return 0
+MIP_FILTERS = ("resample", "box")
 
-    # extract id from filename
-    headerSize = 48
-    split = re.findall("[0-9]+_([0-9a-f]+)", filename)[-1]
-    id = int(split, 16)
+def getMipFilter():
+    if not noesis.optWasInvoked("-mipfilter"):
+        return "resample"
 
-    print("ID detected from filename as " + str(id))
+    filter = noesis.optGetArg("-mipfilter").lower()
+    if filter not in MIP_FILTERS:
+        print("Unknown mipmap filter " + filter + ", using resample")
+        return "resample"
+
+    return filter
+
+# works on any 4 byte per pixel layout, a side that is already 1 pixel is not halved
+
+def boxFilterRGBA(data, width, height, mipWidth, mipHeight):
+    view = memoryview(data)
+    rowSize = width * 4
+    mipRowSize = mipWidth * 4
+    mipData = bytearray(mipRowSize * mipHeight)
+
+    stepX = 8 if width > 1 else 4
+    nextX = 4 if width > 1 else 0
+    nextY = 1 if height > 1 else 0
+
+    for y in range(mipHeight):
+        y1 = y * (1 + nextY)
+        row1 = view[y1 * rowSize:(y1 + 1) * rowSize]
+        row2 = view[(y1 + nextY) * rowSize:(y1 + nextY + 1) * rowSize]
+        start = y * mipRowSize
+
+        # average each channel of the 2x2 blocks, a whole row at a time
+        for c in range(4):
+            mipData[start + c:start + mipRowSize:4] = bytes((a + b + d + e + 2) >> 2 for a, b, d, e in zip(row1[c::stepX], row1[nextX + c::stepX], row2[c::stepX], row2[nextX + c::stepX]))
+
+    return mipData
+
+# yields (data, width, height) for every mipmap below the full size image
+
+def buildMipChain(data, width, height, filter = "resample"):
+    mipWidth = width >> 1
+    mipHeight = height >> 1
+
+    while mipWidth >= 1 and mipHeight >= 1:
+        if filter == "box":
+            data = boxFilterRGBA(data, width, height, mipWidth, mipHeight)
+        else:
+            data = rapi.imageResample(data, width, height, mipWidth, mipHeight)
+
+        width = mipWidth
+        height = mipHeight
+        yield data, width, height
+
+        mipWidth = width >> 1
+        mipHeight = height >> 1
+
+# number of mipmaps buildMipChain yields for an image
+
+def getMipCount(width, height):
+    count = 0
+
+    while (width >> 1) >= 1 and (height >> 1) >= 1:
+        width >>= 1
+        height >>= 1
+        count += 1
+
+    return count
+
+def getDXTLevelSize(width, height, blockSize):
+    return max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * blockSize
+
+# encodes every mipmap of buildMipChain, each level is encoded as soon as it is built
+# from the previous one
+
+def encodeMipChain(data, width, height, format, filter = "resample"):
+    for mipData, mipWidth, mipHeight in buildMipChain(data, width, height, filter):
+        print("Mipmap {}x{}".format(mipWidth, mipHeight))
+        yield rapi.imageEncodeDXT(mipData, 4, mipWidth, mipHeight, format)
+
+DDS_MAGIC = 542327876
+DDS_MIPMAPCOUNT = 0x20000
+
+# DDS header as a TextureData, format is the fourCC and mipCount the number of mipmaps
+# after the top level. None if the file is not a DDS
+
+def readDDS(view):
+    if len(view) < 128 or struct.unpack_from("<I", view, 0)[0] != DDS_MAGIC:
+        return None
+
+    ddsFlags, height, width = struct.unpack_from("<III", view, 8)
+    ddsMipCount = struct.unpack_from("<I", view, 28)[0] if ddsFlags & DDS_MIPMAPCOUNT else 1
+    ddsType = struct.unpack_from("<I", view, 84)[0]
+
+    return TextureData(ddsType, width, height, max(0, ddsMipCount - 1), view[128:])
+
+def getDXTBlockSize(format):
+    return 8 if format == PCD_FORMAT_DXT1 else 16
+
+# size of the top level and the given number of mipmaps
+
+def getDXTChainSize(width, height, blockSize, numMipmaps):
+    chainSize = 0
+
+    for i in range(numMipmaps + 1):
+        chainSize += getDXTLevelSize(width, height, blockSize)
+        width >>= 1
+        height >>= 1
+
+    return chainSize
+
+# Image data of a PCD from the input DDS: its top level followed by the mipmaps, which are
+# copied from the DDS when it has them and encoded otherwise.
+# Returns (formatMagic, data, numMipmaps), or None if the DDS can't be used
+
+def readDDSTexture(data, width, height):
+    dds = readDDS(mapFile(rapi.getInputName()))
+
+    # Check if input file is a DDS file
+    if dds == None:
+            print ("\nInput file is not a DDS file!\nAborting...\n")
+            return None
 
     # set format values based on options
     formatMagic = None
     format = None
 
-    og.seek(84, NOESEEK_ABS)
-    ddsType = og.readUInt()
-    if ddsType == 827611204: #DXT1
+    if dds.format == PCD_FORMAT_DXT1:
         formatMagic = "DXT1"
         format = noesis.NOE_ENCODEDXT_BC1
-    elif ddsType == 894720068: #DXT5
+    elif dds.format == PCD_FORMAT_DXT5:
         formatMagic = "DXT5"
         format = noesis.NOE_ENCODEDXT_BC3
+    else:
+        print ("\nInput DDS is not DXT1 or DXT5!\nAborting...\n")
+        return None
 
-    # write section header
-    bs.writeString("SECT", False)	# cdcEngineTools section magic
-    bs.writeUInt(0)                 # size - will be written later
-    bs.writeByte(SECTION_TEXTURE)   # section type
-    bs.writeByte(0)                 # padding
-    bs.writeUShort(0)               # version id
-    bs.writeUInt(0)                 # packedData
-    bs.writeUInt(id)                # section id
-    bs.writeUInt(0xFFFFFFFF)        # specialisation mask
+    blockSize = getDXTBlockSize(dds.format)
 
-    # write texture header
-    bs.writeString("PCD9", False)       # magic number
-    bs.writeString(formatMagic, False)  # format
-    bs.writeUInt(0)                     # image size - will be written later
-    bs.writeUInt(0)                     # palette size
-    bs.writeUShort(width)               # width
-    bs.writeUShort(height)              # height
-    bs.writeUByte(0)                    # depth
-    bs.writeUByte(0)                    # number of mipmaps
-    bs.writeUShort(3)                   # flags - always 3 on any DXT1/DXT5 texture. 0 in the case of PCD file with no DXT format specified. Maybe will try to deal with it someday, maybe not.
+    # mipmaps already in the DDS can be copied as they are instead of encoding new ones
+    passthroughMips = 0
+    if dds.mipCount > 0 and not noesis.optWasInvoked("-regenmips"):
+        passthroughMips = min(dds.mipCount, getMipCount(width, height))
 
     print("Image is {}x{}".format(width, height))
 
-    # write image data
-    dxtData = rapi.imageEncodeDXT(data, 4, width, height, format)
-    og.seek(128, NOESEEK_ABS)
-    bs.writeBytes(og.readBytes(fsize))
+    if passthroughMips > 0:
+        # image data and the first mipmaps of the DDS in one go
+        print("Copying {} mipmaps from the DDS".format(passthroughMips))
+        return formatMagic, bytes(dds.data[:getDXTChainSize(width, height, blockSize, passthroughMips)]), passthroughMips
 
-    # write mipmaps, mostly copied from old exporter
-    mipWidth = int(width >> 1) 
-    mipHeight = int(height >> 1)
-    numMipmaps = 0
+    # image data, only the top level if the DDS has mipmaps that get rebuilt
+    if dds.mipCount > 0:
+        levels = [bytes(dds.data[:getDXTLevelSize(width, height, blockSize)])]
+    else:
+        levels = [bytes(dds.data)]
 
-    while mipWidth >= 1 and mipHeight >= 1:
-        print("Mipmap {}x{}".format(mipWidth, mipHeight))
+    # mipmaps
+    levels.extend(encodeMipChain(data, width, height, format, getMipFilter()))
+
+    return formatMagic, b"".join(levels), len(levels) - 1
 
-        # resample and encode to format
-        mipData = rapi.imageResample(data, width, height, mipWidth, mipHeight)
-        dxtData = rapi.imageEncodeDXT(mipData, 4, mipWidth, mipHeight, format)
+# extract id from filename, None if it doesn't follow the <n>_<id> convention
 
-        bs.writeBytes(dxtData)
+def parseSectionId(filename):
+    split = re.findall("[0-9]+_([0-9a-f]+)", filename)
+    if len(split) == 0:
+        return None
 
-        numMipmaps += 1
+    return int(split[-1], 16)
 
-        # next mipmap size
-        mipWidth = int(mipWidth >> 1)
-        mipHeight = int(mipHeight >> 1)
+def getSectionId(filename):
+    id = parseSectionId(filename)
 
-    size = bs.tell()
+    print("ID detected from filename as " + str(id))
 
-    # correct section size
-    bs.seek(4, NOESEEK_ABS)
-    bs.writeUInt(size - 24)
+    return id
+
+def packSectionHeader(id, size):
+    return struct.pack("<4sIBBHIII",
+        b"SECT",            # cdcEngineTools section magic
+        size,               # size
+        SECTION_TEXTURE,    # section type
+        0,                  # padding
+        0,                  # version id
+        0,                  # packedData
+        id,                 # section id
+        0xFFFFFFFF)         # specialisation mask
+
+# a whole PC .pcd section file
+
+def packPCD(id, formatMagic, width, height, imageData, numMipmaps):
+    return packSectionHeader(id, len(imageData) + 24) + struct.pack("<4s4sIIHHBBH",
+        b"PCD9",                    # magic number
+        formatMagic.encode(),       # format
+        len(imageData),             # image size
+        0,                          # palette size
+        width,                      # width
+        height,                     # height
+        0,                          # depth
+        numMipmaps,                 # number of mipmaps
+        3) + imageData              # flags - always 3 on any DXT1/DXT5 texture. 0 in the case of PCD file with no DXT format specified. Maybe will try to deal with it someday, maybe not.
+
+def pcdWriteRGBA(data, width, height, bs):
+    filename = rapi.getOutputName()
+
+    texture = readDDSTexture(data, width, height)
+    if texture == None:
+        return 0
 
-    # correct image size
-    bs.seek(32, NOESEEK_ABS)
-    bs.writeUInt(size - 48)
+    formatMagic, imageData, numMipmaps = texture
+    id = getSectionId(filename)
 
-    # correct number of mipmaps, could be calculated above but meh
-    bs.seek(45, NOESEEK_ABS)
-    bs.writeUByte(numMipmaps)
+    # write section and texture header, image data and mipmaps
+    bs.writeBytes(packPCD(id, formatMagic, width, height, imageData, numMipmaps))
     
-    print("Written {} bytes to file".format(size))
+    print("Written {} bytes to file".format(bs.tell()))
+
+    return 1
+
+def ps3pcdWriteRGBA(data, width, height, bs):
+    filename = rapi.getOutputName()
+
+    texture = readDDSTexture(data, width, height)
+    if texture == None:
+        return 0
+
+    formatMagic, imageData, numMipmaps = texture
+    id = getSectionId(filename)
+    format = PS3_TEXTURE_DXT1 if formatMagic == "DXT1" else PS3_TEXTURE_DXT5
+
+    # write section header, same as on PC
+    bs.writeBytes(packSectionHeader(id, len(imageData) + 36))
+
+    # write texture header
+    bs.writeBytes(struct.pack(">4sII", b"PS3T", len(imageData), 0))    # magic number, image size, unknown
+    bs.writeBytes(struct.pack(">BBBBIHHHBBII",
+        format,             # format
+        numMipmaps + 1,     # number of mip levels, including the image itself
+        2,                  # dimension, 2D
+        0,                  # cubemap
+        0xAAE4,             # default component remap
+        width,              # width
+        height,             # height
+        1,                  # depth
+        0,                  # location
+        0,                  # padding
+        0,                  # pitch, unused for DXT
+        0))                 # offset
+
+    # write image data and mipmaps, DXT blocks are stored the same way as on PC
+    bs.writeBytes(imageData)
+
+    print("Written {} bytes to file".format(bs.tell()))
 
     return 1
     
     
 def ps3pcdLoadDDS(data, texList):
-    bs = NoeBitStream(data, 1)
-    bs.seek(0x18, NOESEEK_ABS)
-    magic = bs.readUInt()
-    ddsSize = bs.readUInt()
-    bs.seek(0x24, NOESEEK_ABS)
-    ddsType = bs.readByte()
-    bs.seek(0x2C, NOESEEK_ABS)
-    ddsWidth = bs.readUShort()
-    ddsHeight = bs.readUShort()
-    bs.seek(0x3C, NOESEEK_ABS)
-    ddsData = bs.readBytes(ddsSize)
-    ddsFmt = None
-    if ddsType == -0x7a:
-        ddsFmt = noesis.NOESISTEX_DXT1
-    elif ddsType == -0x78:
-        ddsFmt = noesis.NOESISTEX_DXT5
-    elif ddsType == 0x15:
-        ddsData = rapi.imageDecodeRaw(ddsData, ddsWidth, ddsHeight, "a8a8a8a8")
-        ddsFmt = noesis.NOESISTEX_RGBA32
-    else: 
-        print("Fatal Error: " + "Unknown DDS type: " + str(hex(ddsType)) + " using default DXT1")
-    texList.append(NoeTexture("Texture", ddsWidth, ddsHeight, ddsData, ddsFmt))
-
-    return 1
+    return appendPCDTexture(readPS3PCD(memoryview(data), 0x18), texList)
     
 def rawCheckType(data):
     bs = NoeBitStream(data)
@@ -814,20 +998,50 @@ def rawCheckType(data):
         return 0
 
 def rawLoadDDS(data, texList):
-    bs = NoeBitStream(data)
-    magic = bs.readUInt()
-    bs.seek(0x8, NOESEEK_ABS)
-    ddsSize = bs.readUInt()
-    bs.seek(0x14, NOESEEK_ABS)
-    ddsWidth = bs.readInt()
-    bs.seek(0x18, NOESEEK_ABS)
-    ddsHeight = bs.readInt()
-    bs.seek(0x80, NOESEEK_ABS)
-    ddsData = bs.readBytes(ddsSize)
-    ddsData = rapi.imageDecodeRaw(ddsData, ddsWidth, ddsHeight, "b8g8r8a8")
-    texList.append(NoeTexture("Texture", ddsWidth, ddsHeight, ddsData))
+    return appendRawTexture(readRaw(memoryview(data)), texList)
+
+def appendRawTexture(texture, texList):
+    ddsData = rapi.imageDecodeRaw(bytes(texture.data), texture.width, texture.height, texture.pixelFormat)
+    texList.append(NoeTexture("Texture", texture.width, texture.height, ddsData))
     return 1
     
+# raw textures store the full mip chain down to 1x1, sides stop halving at 1 pixel
+
+def getRawMipSizes(width, height):
+    sizes = [(width, height)]
+
+    while width > 1 or height > 1:
+        width = max(1, width >> 1)
+        height = max(1, height >> 1)
+        sizes.append((width, height))
+
+    return sizes
+
+# yields every raw mipmap of an RGBA image in rawFormat, the full size image first. "resample"
+# resamples each level from the full size image and encodes it with Noesis, like the raw writers
+# always did. "box" swizzles the image once and halves the previous level in Python
+
+def buildRawMipChain(data, mipSizes, rawFormat, swizzle, filter = "resample"):
+    if filter != "box":
+        for i, (mipWidth, mipHeight) in enumerate(mipSizes):
+            mipData = data if i == 0 else rapi.imageResample(data, mipSizes[0][0], mipSizes[0][1], mipWidth, mipHeight)
+            yield rapi.imageEncodeRaw(mipData, mipWidth, mipHeight, rawFormat)
+        return
+
+    mipData = swizzle(data)
+    for i, (mipWidth, mipHeight) in enumerate(mipSizes):
+        if i > 0:
+            mipData = boxFilterRGBA(mipData, mipSizes[i - 1][0], mipSizes[i - 1][1], mipWidth, mipHeight)
+        yield mipData
+
+def swizzleRGBAToBGRA(data):
+    view = memoryview(data)
+    swizzled = bytearray(view)
+    swizzled[0::4] = view[2::4]
+    swizzled[2::4] = view[0::4]
+
+    return swizzled
+
 def rawWriteRGBA(data, width, height, bs):
     brawAsSource = False
     
@@ -854,13 +1068,11 @@ def rawWriteRGBA(data, width, height, bs):
         if newrawName == None:
             return 0		
             
-    newraw = rapi.loadIntoByteArray(newrawName)
-    oldDDS = rapi.loadIntoByteArray(rapi.getInputName())
-    f = NoeBitStream(newraw)
-    og = NoeBitStream(oldDDS)
+    newraw = mapFile(newrawName)
+    oldDDS = mapFile(rapi.getInputName())
     
-    magic = f.readUInt()
-    ddsMagic = og.readUInt()
+    magic = struct.unpack_from("<I", newraw, 0)[0]
+    ddsMagic = struct.unpack_from("<I", oldDDS, 0)[0]
     if magic != 0x52415721:
         print ("Selected file is not a raw file!\nAborting...")
         return 0
@@ -871,37 +1083,130 @@ def rawWriteRGBA(data, width, height, bs):
         else:
             print ("Input file is not a supported format or a raw file\nEncoding...")
     
-    #copy header
-    f.seek(0, NOESEEK_ABS)
-    bs.writeBytes(f.readBytes(128))
+    #the image size is known from the mip chain, so the header is adjusted before it is written
+    mipSizes = getRawMipSizes(width, height)
+    imgSize = sum(mipWidth * mipHeight * 4 for mipWidth, mipHeight in mipSizes)
+    header = bytearray(newraw[0:128])
+    struct.pack_into("<i", header, 0x8, imgSize)
+    struct.pack_into("<ii", header, 0x14, width, height)
+    bs.writeBytes(header)
     
-    #write image data	
-    mipWidth = width
-    mipHeight = height
-    
-    print ("Writing Image Data at:", bs.tell())
-    while mipWidth >= 1 and mipHeight >= 1:
-        mipData = rapi.imageResample(data, width, height, mipWidth, mipHeight)
-        dxtData = rapi.imageEncodeRaw(mipData, mipWidth, mipHeight, "b8g8r8a8")
-        bs.writeBytes(dxtData)
-        
-        if mipWidth == 1 and mipHeight == 1:
-            break
-        if mipWidth > 1:
-            mipWidth = int(mipWidth / 2)
-        if mipHeight > 1:
-            mipHeight = int(mipHeight / 2)
-            
-    imgSize = bs.tell() - 128
-    #adjust header
-    bs.seek(0x8, NOESEEK_ABS)
-    bs.writeInt(imgSize)
-    bs.seek(0x8, NOESEEK_REL)
-    bs.writeInt(width)
-    bs.writeInt(height)
+    #write image data
+    print ("Writing Image Data at:", 128)
+    for mipData in buildRawMipChain(data, mipSizes, "b8g8r8a8", swizzleRGBAToBGRA, getMipFilter()):
+        bs.writeBytes(mipData)
     
     return 1
 
+# Morton (twiddled) pixel order of PS3 raw textures. A Morton code interleaves the bits of
+# both coordinates, so it is the OR of the codes of each coordinate alone and a table only
+# takes width + height calls to noesis.morton2D. Like the RSX swizzle, rectangular textures
+# only interleave the bits both sides have and the longer side's extra high bits follow
+# linearly, so a power of two texture takes exactly width * height pixels. Returns a getter
+# for the pixels in row order and how many pixels it reads
+
+# bit interleave used instead of noesis.morton2D outside of Noesis, x takes the even bits
+
+def morton2D(x, y):
+    code = 0
+    for bit in range(16):
+        code |= (((x >> bit) & 1) << (bit * 2)) | (((y >> bit) & 1) << ((bit * 2) + 1))
+
+    return code
+
+@functools.lru_cache(maxsize = 8)
+def getMortonTable(width, height):
+    morton = noesis.morton2D if noesis != None else morton2D
+    bits = min(width.bit_length(), height.bit_length()) - 1
+    mask = (1 << bits) - 1
+    rows = [morton(x & mask, 0) | ((x >> bits) << (bits * 2)) for x in range(height)]
+    cols = [morton(0, y & mask) | ((y >> bits) << (bits * 2)) for y in range(width)]
+
+    return tuple(row | col for row in rows for col in cols)
+
+def getPixelGetter(table):
+    if len(table) == 1:
+        return lambda pixels: (pixels[table[0]],)
+
+    return operator.itemgetter(*table)
+
+@functools.lru_cache(maxsize = 8)
+def getUntwiddleTable(width, height):
+    table = getMortonTable(width, height)
+
+    return getPixelGetter(table), max(table) + 1
+
+# the inverse, twiddled slots no pixel lands on read the extra zero pixel at the end
+
+@functools.lru_cache(maxsize = 8)
+def getTwiddleTable(width, height):
+    table = getMortonTable(width, height)
+    inverse = [len(table)] * (max(table) + 1)
+
+    for i, index in enumerate(table):
+        inverse[index] = i
+
+    return getPixelGetter(inverse)
+
+def untwiddle32(data, width, height):
+    getter, count = getUntwiddleTable(width, height)
+
+    pixels = array.array("I")
+    pixels.frombytes(data[:len(data) - (len(data) % 4)])
+    if len(pixels) < count:
+        pixels.extend([0] * (count - len(pixels)))
+
+    return array.array("I", getter(pixels)).tobytes()
+
+def twiddle32(data, width, height):
+    getter = getTwiddleTable(width, height)
+
+    pixels = array.array("I")
+    pixels.frombytes(data)
+    pixels.append(0)
+
+    return array.array("I", getter(pixels)).tobytes()
+
+def swizzleRGBAToARGB(data):
+    view = memoryview(data)
+    swizzled = bytearray(len(view))
+    swizzled[0::4] = view[3::4]
+    swizzled[1::4] = view[0::4]
+    swizzled[2::4] = view[1::4]
+    swizzled[3::4] = view[2::4]
+
+    return swizzled
+
+def ps3rawWriteRGBA(data, width, height, bs):
+    newrawName = noesis.userPrompt(noesis.NOEUSERVAL_FILEPATH, "Export over raw", "Choose a PS3 raw file to export over", rapi.getOutputName(), None)
+    while newrawName != None and not rapi.checkFileExists(newrawName):
+        print ("File not found")
+        newrawName = noesis.userPrompt(noesis.NOEUSERVAL_FILEPATH, "Export over raw", "Choose a PS3 raw file to export over", newrawName, None)
+    if newrawName == None:
+        print("Aborting...")
+        return 0
+
+    newraw = mapFile(newrawName)
+    if struct.unpack_from(">I", newraw, 4)[0] != 0x80:
+        print ("Selected file is not a PS3 raw file!\nAborting...")
+        return 0
+
+    #the whole file is built in one buffer, sized from the mip chain
+    mipSizes = getRawMipSizes(width, height)
+    raw = bytearray(newraw[0:128])
+
+    #write image data, every level is twiddled
+    for (mipWidth, mipHeight), mipData in zip(mipSizes, buildRawMipChain(data, mipSizes, "a8r8g8b8", swizzleRGBAToARGB, getMipFilter())):
+        raw += twiddle32(mipData, mipWidth, mipHeight)
+
+    #adjust header, big endian
+    struct.pack_into(">I", raw, 0x8, len(raw) - 128)
+    struct.pack_into(">ii", raw, 0x14, width, height)
+
+    bs.writeBytes(raw)
+
+    return 1
+
 def ps3rawCheckType(data):
     bs = NoeBitStream(data)
     magic = bs.readUInt()
@@ -913,286 +1218,303 @@ def ps3rawCheckType(data):
         return 0
 
 def ps3rawLoadDDS(data, texList):
-    bs = NoeBitStream(data, 1)
-    magic = bs.readUInt()
-    bs.seek(0x8, NOESEEK_ABS)
-    ddsSize = bs.readUInt()
-    bs.seek(0x14, NOESEEK_ABS)
-    ddsWidth = bs.readInt()
-    bs.seek(0x18, NOESEEK_ABS)
-    ddsHeight = bs.readInt()
-    bs.seek(0x80, NOESEEK_ABS)
-    ddsData = bs.readBytes(ddsSize)
-    untwid = bytearray()
-    for x in range(0, ddsHeight):
-        for y in range(0, ddsWidth):
-            idx = noesis.morton2D(x, y)
-            untwid += ddsData[idx*4:idx*4+4]
-    ddsData = rapi.imageDecodeRaw(untwid, ddsWidth, ddsHeight, "a8r8g8b8")
-    texList.append(NoeTexture("Texture", ddsWidth, ddsHeight, ddsData))
-    return 1
+    return appendRawTexture(readPS3Raw(memoryview(data)), texList)
 
 #BGObject
 
 def checkType(data):
     bs = NoeBitStream(data)
     
-    if bs.readUInt() != 14:
-        trace("Invalid DRM version")
-        return 0
-        
-    bs.seek(0, NOESEEK_ABS)
-    drm = SectionList(bs)
+    if bs.readUInt() != 14:
+        trace("Invalid DRM version")
+        return 0
+        
+    # only the section headers are needed to find the first section
+    numSections = bs.readUInt()
+    if numSections == 0 or 8 + (numSections * 0x14) > bs.getSize():
+        trace("DRM section table is truncated")
+        return 0
+        
+    drm = getSectionList(data)
+    
+    if drm.sections[0].offset + 0xAC > bs.getSize():
+        trace("DRM first section is truncated")
+        return 0
+    
+    # skip to first section to read Level structure
+    section = drm.sections[0]
+    bs.seek(section.offset, NOESEEK_ABS)
+    
+    # skip to versionNumber
+    bs.seek(0xA8, NOESEEK_REL)
+    versionNumber = bs.readUInt()
+    
+    if versionNumber != 79824059:
+        trace("DRM does not have level versionNumber")
+        return 0
+    
+    trace("DRM is a level")
+    return 1
+    
+def loadLevel(data, mdlList):
+    ctx = rapi.rpgCreateContext()
+    
+    # reuses the header table parsed by checkType, relocations are only read here
+    drm = getSectionList(data)
+    drm.readRelocations()
+    textures = ReadSectionTextures(drm, noesis.optWasInvoked("-usedtextures"))
+    
+    bgObjects = readLevel(drm)
+    if bgObjects == None:
+        return 0
+    
+    for bgObject in bgObjects:
+        rapi.rpgBindPositionBuffer(bgObject.vertices, noesis.RPGEODATA_FLOAT, 12)
+        rapi.rpgBindUV1Buffer(bgObject.uvs, noesis.RPGEODATA_FLOAT, 8)
+        
+        for strip in bgObject.strips:
+            textures.request(strip.tpageid)
+            rapi.rpgSetMaterial("Material_" + str(strip.tpageid))
+            rapi.rpgCommitTriangles(bytes(strip.indices), noesis.RPGEODATA_USHORT, strip.numVertices, noesis.RPGEO_TRIANGLE, 1)
+        
+        mdl = rapi.rpgConstructModel()
+        mdl.setModelMaterials(NoeModelMaterials(textures.textures, textures.materials))
+        
+        rapi.rpgClearBufferBinds()
+        rapi.rpgReset()
+        
+        mdlList.append(mdl)
+        
+    return 1
+    
+# usedOnly leaves the textures to be decoded when a texture strip requests them
+def ReadSectionTextures(drm, usedOnly = False):
+    textures = TextureLoader()
+    
+    for section in drm.sections:
+        if section.type == SECTION_TEXTURE:
+            textures.add(section.id, lambda section = section: ReadSectionTexture(drm, section))
+    
+    if not usedOnly:
+        textures.requestAll()
+    
+    return textures
+    
+def ReadSectionTexture(drm, section):
+    texture = drm.readTexture(section)
     
-    # skip to first section to read Level structure
-    section = drm.sections[0]
-    bs.seek(section.offset, NOESEEK_ABS)
+    format = None
+    if texture.format == PCD_FORMAT_DXT1 or texture.format == PCD_FORMAT_DXT5:
+        format = getNoeTextureFormat(texture.format)
+    else:
+        trace("section {} has texture with format {}".format(section.id, texture.format))
+        return None
     
-    # skip to versionNumber
-    bs.seek(0xA8, NOESEEK_REL)
-    versionNumber = bs.readUInt()
+    material = NoeMaterial("Material_" + str(section.id), "")
+    material.setTexture("Texture_" + str(section.id))
     
-    if versionNumber != 79824059:
-        trace("DRM does not have level versionNumber")
-        return 0
+    return NoeTexture("Texture_" + str(section.id), texture.width, texture.height, bytes(texture.data), format), material
     
-    trace("DRM is a level")
-    return 1
+# Level geometry, every BGObject of the terrain with its vertices and texture strips
+
+class BGObjectData:
+    vertices = None
+    uvs = None
+    strips = None
     
-def loadLevel(data, mdlList):
-    bs = NoeBitStream(data)
-    ctx = rapi.rpgCreateContext()
+class TextureStrip:
+    numVertices = None
+    tpageid = None
+    indices = None
+    
+    def __init__(self, numVertices, tpageid, indices):
+        self.numVertices = numVertices
+        self.tpageid = tpageid
+        self.indices = indices
     
-    drm = SectionList(bs, True)
+BGOBJECT_SIZE = 0x60
+BGOBJECT_VERTEX_STRUCT = struct.Struct("<3h2x2h")
     
+# returns the BGObjects, or None if the level can't be read
+def readLevel(drm):
     # first section, level structure
     section = drm.sections[0]
-    bs.seek(section.offset, NOESEEK_ABS)
     
-    ptr = drm.pointerHere(bs, section)
+    ptr = drm.pointerAt(section, section.offset)
     if ptr == None:
         print("Failed to read terrain, was nullptr")
-        return 0
+        return None
         
-    bs.seek(ptr.offset, NOESEEK_ABS)
+    return readTerrain(drm, ptr)
     
-    return readTerrain(bs, drm, ptr.section, mdlList)
-    
-def readTerrain(bs, drm, section, mdlList):
-    # terrain structure, skip to 0x30 for bgobject members
-    bs.seek(0x30, NOESEEK_REL)
-    
-    numBGObjects = bs.readUInt()
+def readTerrain(drm, terrain):
+    # terrain structure, bgobject members at 0x30
+    numBGObjects = struct.unpack_from("<I", drm.view, terrain.offset + 0x30)[0]
     print(str(numBGObjects) + " BGObjects in terrain")
     
-    ptr = drm.pointerHere(bs, section)
+    ptr = drm.pointerAt(terrain.section, terrain.offset + 0x34)
     if ptr == None:
         print("Level has no BGObjects")
-        return 0
+        return None
         
-    bs.seek(ptr.offset, NOESEEK_ABS)
+    return readBGObjectList(drm, ptr, numBGObjects)
     
-    return readBGObjectList(bs, drm, ptr.section, numBGObjects, mdlList)
+def readBGObjectList(drm, ptr, numBGObjects):
+    view = drm.view
+    bgObjects = []
     
-def readBGObjectList(bs, drm, section, numBGObjects, mdlList):
     # go trough all bg objects
     for i in range(numBGObjects):
-        scaleX = bs.readFloat()
-        scaleY = bs.readFloat()
-        scaleZ = bs.readFloat()
-    
-        # read the vertexCount and seek back
-        bs.seek(0x3C, NOESEEK_REL)
-        vertexCount = bs.readUInt()
-        bs.seek(-8, NOESEEK_REL)
+        offset = ptr.offset + (i * BGOBJECT_SIZE)
+        scaleX, scaleY, scaleZ = struct.unpack_from("<3f", view, offset)
+        vertexCount = struct.unpack_from("<I", view, offset + 0x48)[0]
         
         trace(str(vertexCount) + " vertexCount for bgobject " + str(i))
         
-        oldOffset = bs.tell()
-        
-        # seek to vertex list
-        ptr = drm.pointerHere(bs, section)
-        if ptr == None:
+        vertexList = drm.pointerAt(ptr.section, offset + 0x44)
+        if vertexList == None:
             print("No vertex list")
-            return 0
-            
-        bs.seek(ptr.offset, NOESEEK_ABS)
+            return None
         
-        vertices = bytearray(vertexCount * 12)
-        uvs = bytearray(vertexCount * 8)
+        bgObject = BGObjectData()
         
-        for v in range(vertexCount):
-            x = -(bs.readShort() * scaleX)
-            z = bs.readShort() * scaleY
-            y = bs.readShort() * scaleZ
-            
-            bs.seek(2, NOESEEK_REL)
-            
-            uvx = bs.readShort() * 0.00024414062
-            uvy = bs.readShort() * 0.00024414062
-            
-            struct.pack_into("<fff", vertices, v * 12, x, y, z)
-            struct.pack_into("<ff", uvs, v * 8, uvx, uvy)
-            
-        rapi.rpgBindPositionBuffer(vertices, noesis.RPGEODATA_FLOAT, 12)
-        rapi.rpgBindUV1Buffer(uvs, noesis.RPGEODATA_FLOAT, 8)
+        # decode the whole vertex list at once, y and z are swapped and x is mirrored
+        block = view[vertexList.offset:vertexList.offset + (vertexCount * BGOBJECT_VERTEX_STRUCT.size)]
+        vertices = [c for x, z, y, uvx, uvy in BGOBJECT_VERTEX_STRUCT.iter_unpack(block) for c in (-(x * scaleX), y * scaleZ, z * scaleY)]
+        uvs = [c * 0.00024414062 for vertex in BGOBJECT_VERTEX_STRUCT.iter_unpack(block) for c in vertex[3:5]]
         
-        # seek back and seek to strip info
-        bs.seek(oldOffset - 0x14, NOESEEK_ABS)
+        bgObject.vertices = struct.pack("<%df" % len(vertices), *vertices)
+        bgObject.uvs = struct.pack("<%df" % len(uvs), *uvs)
         
-        strip = drm.pointerHere(bs, section)
-        oldOffset = bs.tell()
+        # follow texture strips
+        bgObject.strips = readTextureStrips(drm, drm.pointerAt(ptr.section, offset + 0x30))
         
-        # follow texture strip
-        readTextureStrip(bs, drm, strip)
+        bgObjects.append(bgObject)
         
-        # return to original position and skip to end of this BGobject
-        bs.seek(oldOffset + 0x2C, NOESEEK_ABS)	
+    # done?
+    return bgObjects
+    
+def readTextureStrips(drm, ptr):
+    strips = []
+    
+    while ptr != None:
+        numVertices = struct.unpack_from("<I", drm.view, ptr.offset)[0]
         
-        mdl = rapi.rpgConstructModel()
-        mdl.setModelMaterials(NoeModelMaterials(drm.textures, drm.materials))
+        trace(str(numVertices) + " vertices")
         
-        rapi.rpgClearBufferBinds()
-        rapi.rpgReset()
+        if numVertices == 0:
+            break
         
-        mdlList.append(mdl)
+        tpageid = struct.unpack_from("<I", drm.view, ptr.offset + 12)[0] & 0x1FFF
         
-    # done?
-    return 1
-    
-def readTextureStrip(bs, drm, ptr):
-    bs.seek(ptr.offset, NOESEEK_ABS)
-    
-    numVertices = bs.readUInt()
-    
-    trace(str(numVertices) + " vertices")
-    
-    if numVertices == 0:
-        return
-    
-    bs.seek(8, NOESEEK_REL)
-    tpageid = bs.readUInt() & 0x1FFF
-    
-    trace("tpageid " + str(tpageid))
-    
-    bs.seek(8, NOESEEK_REL)
-    
-    # read ptr, then after read the vertice list
-    ptr = drm.pointerHere(bs, ptr.section)
+        trace("tpageid " + str(tpageid))
+        
+        # read ptr, the indices come after it
+        next = drm.pointerAt(ptr.section, ptr.offset + 24)
+        indices = drm.view[ptr.offset + 28:ptr.offset + 28 + (numVertices * 2)]
+        
+        strips.append(TextureStrip(numVertices, tpageid, indices))
+        
+        if next == None:
+            trace("strip ptr is nullptr")
+        
+        ptr = next
+        
+    return strips
+
+# Section tables of the last few DRMs, so checkType and loadLevel (and reloads of the
+# same file) share one parse. Only the Section objects are kept, never the file data.
+# Entries are keyed by file size and a checksum of the section header table alone
+
+SECTION_CACHE_SIZE = 4
+sectionCache = {}
+
+def getSectionList(data):
+    view = memoryview(data)
+    numSections = struct.unpack_from("<I", view, 4)[0]
+    key = (len(view), zlib.crc32(view[0:8 + (numSections * 0x14)]))
     
-    indices = bs.readBytes(numVertices * 2)
+    cached = sectionCache.pop(key, None)
+    if cached != None:
+        drm = SectionList(view, sections = cached)
+    else:
+        drm = SectionList(view, headerOnly = True)
     
-    rapi.rpgSetMaterial("Material_" + str(tpageid))
-    rapi.rpgCommitTriangles(indices, noesis.RPGEODATA_USHORT, numVertices, noesis.RPGEO_TRIANGLE, 1)
+    # (re)insert as most recently used and drop the oldest entries
+    sectionCache[key] = drm.sections
+    while len(sectionCache) > SECTION_CACHE_SIZE:
+        del sectionCache[next(iter(sectionCache))]
     
-    if ptr == None:
-        trace("strip ptr is nullptr")
-        return
-        
-    readTextureStrip(bs, drm, ptr)
+    return drm
 
 def trace(str):
     if False: # set to True for logging
         print(str)
 
 # based on https://github.com/TheIndra55/TR7AE-level-viewer/blob/main/src/Section.ts
+
+SECTION_HEADER_STRUCT = struct.Struct("<Ib3xII4x")
+RELOCATION_STRUCT = struct.Struct("<h2xI")
+
 class SectionList:
-    bs = None
+    view = None
     sections = None
     
-    # Noesis specific
-    materials = []
-    textures = []
-    
-    def __init__(self, bs, loadTextures = False):
-        self.bs = bs
+    # headerOnly only reads the section header table and works out the section offsets
+    # from it, without touching any relocation or section data. Enough for type checks.
+    # sections reuses an already parsed header table
+    def __init__(self, data, headerOnly = False, sections = None):
+        self.view = memoryview(data)
+        
+        if sections != None:
+            self.sections = sections
+            return
+        
         self.sections = []
         
-        version = bs.readUInt()
-        numSections = bs.readUInt()
+        version, numSections = struct.unpack_from("<II", self.view, 0)
         
         trace("version " + str(version) + " numSections " + str(numSections))
         
-        for i in range(numSections):
-            section = self.readSection()
+        offset = 8 + (numSections * 0x14)
+        for size, type, packedData, id in SECTION_HEADER_STRUCT.iter_unpack(self.view[8:offset]):
+            section = Section(size, type, packedData >> 8, id)
             self.sections.append(section)
 
             #trace("section {}, size {}".format(i, section.size))
         
         for section in self.sections:
-            section.readRelocations(bs)
-            
-            # seek cursor to end of section to read next relocations
-            bs.seek(section.size, NOESEEK_REL)
-            
-            # is it a texture?
-            if section.type == 5 and loadTextures: # SectionType.Texture
-                self.readTexture(bs, section)
-    
-    def readSection(self):
-        bs = self.bs
-    
-        size = bs.readUInt()
-        type = bs.readByte()
-        bs.seek(3, NOESEEK_REL)
+            # relocations are 8 bytes each and come right before the section data
+            section.offset = offset + (section.numRelocations * 8)
+            offset = section.offset + section.size
         
-        packedData = bs.readUInt()
-        id = bs.readUInt()
-        bs.seek(4, NOESEEK_REL)
+        if headerOnly:
+            return
         
-        section = Section(size, type, packedData >> 8, id)
-        return section
+        self.readRelocations()
+    
+    def readRelocations(self):
+        for section in self.sections:
+            section.readRelocations(self.view)
 
-    # reads an offset, gets the associated relocation and follows it. 
-    def pointerHere(self, bs, section):
-        offset = bs.tell() - section.offset
-        
-        #trace(str(offset) + " < ptr")
+    # reads the offset at the given file offset, gets the associated relocation and follows it. 
+    def pointerAt(self, section, offset):
+        #trace(str(offset - section.offset) + " < ptr")
         
-        relocation = section.findRelocation(offset)
+        relocation = section.findRelocation(offset - section.offset)
         
         if relocation == None:
-            # move cursor and return nullptr
-            bs.seek(4, NOESEEK_REL)             
+            # nullptr
             return None
             
         target = self.sections[relocation.section]
-        pointer = Pointer(target, target.offset + bs.readUInt())
+        pointer = Pointer(target, target.offset + struct.unpack_from("<I", self.view, offset)[0])
         
         return pointer
         
-    def readTexture(self, bs, section):
-        oldOffset = bs.tell() # so we can reset the cursor after
-        bs.seek(section.offset, NOESEEK_ABS)
-        
-        material = NoeMaterial("Material_" + str(section.id), "")
-        bs.seek(4, NOESEEK_REL)
-        
-        format = bs.readUInt()
-        bitmapSize = bs.readUInt()
-        bs.seek(4, NOESEEK_REL)
-        width = bs.readUShort()
-        height = bs.readUShort()
-        
-        # seek to texture data
-        bs.seek(4, NOESEEK_REL)
-        data = bs.readBytes(bitmapSize)
-        
-        bs.seek(oldOffset, NOESEEK_ABS)
-        
-        texture = None
-        if format == 0x31545844: # DXT1
-            texture = NoeTexture("Texture_" + str(section.id), width, height, data, noesis.NOESISTEX_DXT1)
-        elif format == 0x35545844: # DXT5
-            texture = NoeTexture("Texture_" + str(section.id), width, height, data, noesis.NOESISTEX_DXT5)
-        else:
-            trace("section {} has texture with format {}".format(section.id, format))
-            return
-            
-        material.setTexture("Texture_" + str(section.id))
-        
-        self.materials.append(material)
-        self.textures.append(texture)
+    def readTexture(self, section):
+        # PCD9 header, texture data follows at 0x18
+        return readPCD(self.view, section.offset)
         
 class Section:
     size = None
@@ -1202,6 +1524,9 @@ class Section:
     
     relocations = None
     
+    # relocations keyed by their offset in the section
+    relocationIndex = None
+    
     # offset in the file where the section data starts (after relocations)
     offset = None
     
@@ -1211,30 +1536,28 @@ class Section:
         self.numRelocations = numRelocations
         self.id = id
         self.relocations = []
+        self.relocationIndex = {}
         
-    def readRelocations(self, bs):
-        for i in range(self.numRelocations):
-            typeAndSectionInfo = bs.readShort()
-            bs.seek(2, NOESEEK_REL)
-            
+    # (re)reads the relocations from this file, the Section may come from the cache
+    def readRelocations(self, view):
+        start = self.offset - (self.numRelocations * 8)
+        self.relocations = []
+        self.relocationIndex = {}
+        
+        for typeAndSectionInfo, offset in RELOCATION_STRUCT.iter_unpack(view[start:self.offset]):
             relocation = Relocation()
             relocation.section = typeAndSectionInfo >> 3
-            relocation.offset = bs.readUInt()
+            relocation.offset = offset
             
-            #trace("{} {} {}".format(relocation.section, relocation.offset, bs.tell()))
+            #trace("{} {}".format(relocation.section, relocation.offset))
             
             self.relocations.append(relocation)
             
-        self.offset = bs.tell()
+            # a later relocation for the same offset wins, same as the old linear scan
+            self.relocationIndex[relocation.offset] = relocation
         
     def findRelocation(self, offset):
-        found = None
-        
-        for relocation in self.relocations:
-            if relocation.offset == offset:
-                found = relocation
-        
-        return found 
+        return self.relocationIndex.get(offset)
         
 class Relocation:
     section = None
@@ -1248,32 +1571,232 @@ class Pointer:
         self.section = section
         self.offset = offset
 
+#The exporter copies HInfo and relocations from 5_0.tr7aemesh of lara.drm. It is taken from -template,
+#then the TR7AE_MESH_TEMPLATE environment variable, then a 5_0.tr7aemesh next to this file,
+#and only asked for when none of them is set so exports can run without any prompt
+
+MESH_TEMPLATE_ENV = "TR7AE_MESH_TEMPLATE"
+MESH_TEMPLATE_NAME = "5_0.tr7aemesh"
+
+def getMeshTemplate():
+    if noesis.optWasInvoked("-template"):
+        path = noesis.optGetArg("-template")
+    elif os.environ.get(MESH_TEMPLATE_ENV):
+        path = os.environ[MESH_TEMPLATE_ENV]
+    else:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), MESH_TEMPLATE_NAME)
+        if not os.path.isfile(path):
+            return promptMeshTemplate()
+
+    if not os.path.isfile(path):
+        print ("Template " + path + " not found!")
+        return None
+
+    print ("Using template " + path)
+    return path
+
+def promptMeshTemplate():
+    def getExportName():
+		
+        newMeshName = ((re.sub(r'\.mesh\..*', "", rapi.getInputName().lower()).replace(".meshout","")).replace(".fbx","").replace(".tr7aemesh","").replace("out.",""))
+        newMeshName = noesis.userPrompt(noesis.NOEUSERVAL_FILEPATH, "Export over tr7aemesh", "Choose 5_0.tr7aemesh from lara.drm. You cannot export over any other file.", newMeshName + ".tr7aemesh", None)
+        if newMeshName == None:
+            print("Aborting...")
+            return
+        return newMeshName
+
+    newMeshName = getExportName()
+    if newMeshName == None:
+        return None
+    while not (rapi.checkFileExists(newMeshName)):
+        print ("File not found!")
+        newMeshName = getExportName()	
+        if newMeshName == None:
+            return None
+
+    return newMeshName
+
+#VirtSegment records of the exporter, 0x40 bytes each: unused bounds, transform, flags,
+#FirstVertex, LastVertex, index, weightIndex and weight
+
+VIRTSEGMENT_RECORD_STRUCT = struct.Struct("<32x4fihhhhf")
+
+#Weights closer than 1 / VIRTSEGMENT_WEIGHT_STEPS share a VirtSegment
+
+VIRTSEGMENT_WEIGHT_STEPS = 4096
+
+#Bone matrices of one export, indexed by remapped bone and computed once instead of per vertex
+
+class BoneTransforms:
+    world = None
+    inverseWorld = None
+    parents = None
+    local = None
+    segmentTransforms = None
+
+    def __init__(self, finalJointList, indexRemap):
+        self.world = [bone.getMatrix() for bone in finalJointList]
+        self.inverseWorld = [mat.inverse() for mat in self.world]
+        self.parents = [indexRemap[bone.parentIndex] for bone in finalJointList]
+        #Parent-relative matrices, roots keep their world matrix
+        self.local = []
+        for b, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.local.append(self.world[b] * self.inverseWorld[parent])
+            else:
+                self.local.append(self.world[b])
+        self.segmentTransforms = {}
+
+    #Translation from weightIndex to index, relative to the parent of weightIndex. Roots use
+    #the last bone as parent here, like the original VirtSegment code did
+
+    def getSegmentTransform(self, index, weightIndex):
+        key = (index, weightIndex)
+        transform = self.segmentTransforms.get(key)
+        if transform is None:
+            parentInverse = self.inverseWorld[self.parents[weightIndex]]
+            mat2 = self.world[weightIndex] * parentInverse
+            mat3 = self.world[index] * parentInverse
+            transform = (-mat2[3][0] + mat3[3][0], -mat2[3][1] + mat3[3][1], -mat2[3][2] + mat3[3][2], 1)
+            self.segmentTransforms[key] = transform
+        return transform
+
+    #Moves each position into the space of its bone
+
+    def transformPoints(self, bones, positions):
+        inverseWorld = self.inverseWorld
+        return [inverseWorld[b].transformPoint(pos) for b, pos in zip(bones, positions)]
+
+#Returns (transform, index, weightIndex, weight) of the VirtSegment of a vertex. index is the
+#higher bone and the transform goes from weightIndex to it, relative to the parent of weightIndex
+
+def getVirtSegment(skinVert, boneTransforms, indexRemap):
+    if len(skinVert.indices) == 1 or skinVert.indices[0] == skinVert.indices[1]:
+        index = indexRemap[skinVert.indices[0]]
+        return (0, 0, 0, 0), index, index, skinVert.weights[-1]
+
+    if skinVert.indices[0] > skinVert.indices[1]:
+        index = indexRemap[skinVert.indices[0]]
+        weightIndex = indexRemap[skinVert.indices[1]]
+        weight = skinVert.weights[1]
+    else:
+        index = indexRemap[skinVert.indices[1]]
+        weightIndex = indexRemap[skinVert.indices[0]]
+        weight = skinVert.weights[0]
+
+    return boneTransforms.getSegmentTransform(index, weightIndex), index, weightIndex, weight
+
+#Sorts the vertices by their skinning, like the game's own meshes: rigid vertices first, grouped by
+#bone, then blended vertices grouped by (index, weightIndex, weight) with one VirtSegment for each
+#run. Returns the new vertex order, the new index of every vertex, the BoneID of every vertex in the
+#new order, the (FirstVertex, LastVertex) range of every bone with rigid vertices and the segments
+#as (transform, index, weightIndex, weight, FirstVertex, LastVertex)
+
+def groupVertices(skinning, numBones):
+    keys = []
+    for transform, index, weightIndex, weight in skinning:
+        if index == weightIndex:
+            keys.append((0, index, index, 0))
+        else:
+            keys.append((1, index, weightIndex, round(weight * VIRTSEGMENT_WEIGHT_STEPS)))
+    vertexOrder = sorted(range(len(skinning)), key=keys.__getitem__)
+    newIndices = [0] * len(skinning)
+    vertexBoneIds = []
+    boneRanges = {}
+    segments = []
+    lastKey = None
+    for newIdx, vertIdx in enumerate(vertexOrder):
+        newIndices[vertIdx] = newIdx
+        key = keys[vertIdx]
+        blended, index, weightIndex, weight = key
+        if not blended:
+            boneRanges.setdefault(index, [newIdx, newIdx])[1] = newIdx
+            vertexBoneIds.append(index)
+            continue
+
+        if key == lastKey:
+            segments[-1][5] = newIdx
+        else:
+            segments.append([skinning[vertIdx][0], index, weightIndex, weight / VIRTSEGMENT_WEIGHT_STEPS, newIdx, newIdx])
+            lastKey = key
+        vertexBoneIds.append(numBones + len(segments) - 1)
+
+    return vertexOrder, newIndices, vertexBoneIds, boneRanges, segments
+
+#Vertices whose position, normal, UV and weights round to the same multiple of the weld epsilon
+#are written once, in one mesh or across meshes. FBX imports are full of such duplicates
+
+WELD_EPSILON = 0.00001
+
+def getWeldEpsilon():
+    if not noesis.optWasInvoked("-weldepsilon"):
+        return WELD_EPSILON
+
+    return max(0.0, float(noesis.optGetArg("-weldepsilon")))
+
+#Returns the (mesh, vertex) of every welded vertex and the indices of every mesh remapped to them
+
+def weldVertices(meshes, epsilon):
+    vertexSources = []
+    meshIndices = []
+    welded = {}
+    for m, mesh in enumerate(meshes):
+        remap = []
+        for vertIdx in range(len(mesh.positions)):
+            if epsilon > 0:
+                skinVert = mesh.weights[vertIdx]
+                pos = mesh.positions[vertIdx]
+                normal = mesh.normals[vertIdx]
+                uv = mesh.uvs[vertIdx]
+                key = (round(pos[0] / epsilon), round(pos[1] / epsilon), round(pos[2] / epsilon),
+                    round(normal[0] / epsilon), round(normal[1] / epsilon), round(normal[2] / epsilon),
+                    round(uv[0] / epsilon), round(uv[1] / epsilon), tuple(skinVert.indices),
+                    tuple(round(weight / epsilon) for weight in skinVert.weights))
+                if key in welded:
+                    remap.append(welded[key])
+                    continue
+                welded[key] = len(vertexSources)
+
+            remap.append(len(vertexSources))
+            vertexSources.append((m, vertIdx))
+        meshIndices.append([remap[idx] for idx in mesh.indices])
+
+    return vertexSources, meshIndices
+
 #tr7aemesh mesh exporter by Raq
 #In case you're wondering, no, I'm not good at this. I barely know what I'm doing. This code is a huge mess.
 def meshWriteModel(mdl, bs):
     filename = rapi.getOutputName()
 
-    # check if model exceeds vertex limit
-
-    numVerts = 0
+    # check if model has any vertex without weights or exceeding 2 weights
 
     for m, mesh in enumerate(mdl.meshes):
-        numVerts += len(mesh.positions)
-
-        if numVerts > 21850:
-            print ("\nERROR: This model exceeds the limit of 21850 vertices")
+        if len(mesh.weights) < len(mesh.positions):
+            print ("\nERROR: This model contains vertices without weights")
             return 0
 
-    # check if model has any vertex exceeding 2 weights
-
-    for m, mesh in enumerate(mdl.meshes):
-        f = []
         for vertIdx,skinVert in enumerate(mesh.weights):
 
             if len(skinVert.indices) > 2:
                 print ("\nERROR: This model contains vertices with more than 2 weights")
                 return 0
 
+            if len(skinVert.indices) == 0:
+                print ("\nERROR: This model contains vertices without weights")
+                return 0
+
+    # weld duplicate vertices, then check if model exceeds vertex limit
+
+    vertexSources, meshIndices = weldVertices(mdl.meshes, getWeldEpsilon())
+
+    numVerts = sum(len(mesh.positions) for mesh in mdl.meshes)
+    if len(vertexSources) < numVerts:
+        print ("Welded " + str(numVerts) + " vertices into " + str(len(vertexSources)))
+
+    if len(vertexSources) > 21850:
+        print ("\nERROR: This model exceeds the limit of 21850 vertices")
+        return 0
+
     # extract id from filename
     split = re.split("[\\\\_.]", filename)[-3]
     id = int(split)
@@ -1284,7 +1807,6 @@ def meshWriteModel(mdl, bs):
     vt = NoeBitStream()
     fc = NoeBitStream()
     mf = NoeBitStream()
-    global doNorms, bDoAutoScale, bNoGuns, bNoShotgun, bNoGear
     ctx = rapi.rpgCreateContext()
 
     bNoGuns = noesis.optWasInvoked("-noguns")
@@ -1298,15 +1820,6 @@ def meshWriteModel(mdl, bs):
     print (" -noshotgun  =  Export with the holstered shotgun removed")
     print (" -nogear  =  Export with all gear attachments removed\n")
 
-    def getExportName():
-		
-        newMeshName = ((re.sub(r'\.mesh\..*', "", rapi.getInputName().lower()).replace(".meshout","")).replace(".fbx","").replace(".tr7aemesh","").replace("out.",""))
-        newMeshName = noesis.userPrompt(noesis.NOEUSERVAL_FILEPATH, "Export over tr7aemesh", "Choose 5_0.tr7aemesh from lara.drm. You cannot export over any other file.", newMeshName + ".tr7aemesh", None)
-        if newMeshName == None:
-            print("Aborting...")
-            return
-        return newMeshName
-
     def roundByte(value):
         if value < 0: 
             value -= 1 
@@ -1314,29 +1827,21 @@ def meshWriteModel(mdl, bs):
             value += 1
         return int(value)
 
-    newMeshName = getExportName()
+    newMeshName = getMeshTemplate()
     if newMeshName == None:
         return 0
-    while not (rapi.checkFileExists(newMeshName)):
-        print ("File not found!")
-        newMeshName = getExportName()	
-        if newMeshName == None:
-            return 0
 
     newMesh = rapi.loadIntoByteArray(newMeshName)
     z = NoeBitStream(newMesh)
 
-    if noesis.optWasInvoked("-noguns"):
+    if bNoGuns:
         print ("Exporting with removed holstered guns attachment")
-        bNoGuns = True
 
-    if noesis.optWasInvoked("-noshotgun"):
+    if bNoShotgun:
         print ("Exporting with removed holstered shotgun attachment")
-        bNoShotgun = True
 
-    if noesis.optWasInvoked("-nogear"):
+    if bNoGear:
         print ("Exporting with removed gear attachments (grapple hook excluded)")
-        bNoGear = True
 
     #Write header
     sd.seek(0)
@@ -1427,6 +1932,23 @@ def meshWriteModel(mdl, bs):
     for i,f in enumerate(permIndices):
         indexRemap[f] = i
         indexRemap[-1] = -1
+    boneTransforms = BoneTransforms(finalJointList, indexRemap)
+
+    #Sort the welded vertices into bone ranges and VirtSegments
+    skinning = []
+    vertexBones = []
+    positions = []
+    for m, vertIdx in vertexSources:
+        skinVert = mdl.meshes[m].weights[vertIdx]
+        skinning.append(getVirtSegment(skinVert, boneTransforms, indexRemap))
+        vertexBones.append(indexRemap[skinVert.indices[0]])
+        positions.append(mdl.meshes[m].positions[vertIdx])
+
+    #Positions are stored relative to the first bone of each vertex
+    finalPositions = boneTransforms.transformPoints(vertexBones, positions)
+
+    vertexOrder, newIndices, vertexBoneIds, boneRanges, segments = groupVertices(skinning, len(mdl.bones))
+
     for b, bone in enumerate(finalJointList):
         #Null all the min/max values, they are probably for bounding boxes used during development and they're useless
         sd.writeFloat(0)
@@ -1438,182 +1960,33 @@ def meshWriteModel(mdl, bs):
         sd.writeFloat(0)
         sd.writeUInt(0)
         #Write the transforms
-        if indexRemap[bone.parentIndex] >= 0:
-            mat = bone.getMatrix() * finalJointList[indexRemap[bone.parentIndex]].getMatrix().inverse()
-        else:
-            mat = bone.getMatrix()
-        mat[3] *= (1 / 1)
+        mat = boneTransforms.local[b]
         sd.writeFloat(mat[3][0])
         sd.writeFloat(mat[3][1])
         sd.writeFloat(mat[3][2])
         sd.writeUInt(1065353216)
         #Flags
         sd.writeUInt(0)
-        #Nulling First/LastVertex for every bone because I'm just writing a VirtSegment for each vertex
+        #First/LastVertex of the rigid vertices of the bone, 0 and -1 if there are none
+        firstVertex, lastVertex = boneRanges.get(b, (0, -1))
         #FirstVertex
-        sd.writeShort(0)
+        sd.writeShort(firstVertex)
         #LastVertex
-        sd.writeShort(-1)
+        sd.writeShort(lastVertex)
         #BoneParent
         sd.writeUInt(indexRemap[bone.parentIndex])
         #HInfo
         sd.writeUInt(0)
 
-    #Write VirtSegments
-    finalPositions = []
+    #Write VirtSegments, one for each run of blended vertices with the same skinning, built in one
+    #buffer of 0x40 byte records and written at once
     startofVirtSegments = sd.tell()
-    virtsBefore = 0
-    for m, mesh in enumerate(mdl.meshes):
-        f = []
-        for vertIdx,skinVert in enumerate(mesh.weights):
+    virtSegments = bytearray(len(segments) * VIRTSEGMENT_RECORD_STRUCT.size)
+    for s, (transform, index, weightIndex, weight, firstVertex, lastVertex) in enumerate(segments):
+        #Flags are always 8
+        VIRTSEGMENT_RECORD_STRUCT.pack_into(virtSegments, s * VIRTSEGMENT_RECORD_STRUCT.size, *transform, 8, firstVertex, lastVertex, index, weightIndex, weight)
 
-            #Null all the min/max values, they are probably for bounding boxes used during development and they're useless
-            sd.writeFloat(0)
-            sd.writeFloat(0)
-            sd.writeFloat(0)
-            sd.writeUInt(0)
-            sd.writeFloat(0)
-            sd.writeFloat(0)
-            sd.writeFloat(0)
-            sd.writeUInt(0)
-            #Write the transforms
-            if len(skinVert.indices)>1:
-                whateverIdx = indexRemap[skinVert.indices[1]]
-            if len(skinVert.indices)==1:
-                whateverIdx = indexRemap[skinVert.indices[0]]
-            if len(skinVert.indices)>1:
-                if (skinVert.indices[0])>(skinVert.indices[1]):
-                    whateverIdx = indexRemap[skinVert.indices[0]]
-                if (skinVert.indices[0])<(skinVert.indices[1]):
-                    whateverIdx = indexRemap[skinVert.indices[1]]
-
-
-            bone = finalJointList[whateverIdx]
-            mat2 = bone.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-            jointPos = finalJointList[whateverIdx].getMatrix()[3]
-
-            transforms = sd.tell()
-            if len(skinVert.weights)>1:
-                if (skinVert.indices[0])>(skinVert.indices[1]):
-                     sd.writeFloat(mat2[3][0])
-                     sd.writeFloat(mat2[3][1])
-                     sd.writeFloat(mat2[3][2])
-                     sd.writeFloat(1)
-                if (skinVert.indices[0])<(skinVert.indices[1]):
-                     sd.writeFloat(-mat2[3][0])
-                     sd.writeFloat(-mat2[3][1])
-                     sd.writeFloat(-mat2[3][2])
-                     sd.writeFloat(1)
-            if len(skinVert.weights)==1:
-                sd.writeFloat(0)
-                sd.writeFloat(0)
-                sd.writeFloat(0)
-                sd.writeFloat(0)
-            #Flags
-            sd.writeInt(8)
-            #FirstVertex
-            sd.writeShort(vertIdx + virtsBefore)
-            #LastVertex
-            sd.writeShort(vertIdx + virtsBefore)
-            #write index, weightIndex and weight
-            if len(skinVert.indices)>1:
-                if (skinVert.indices[0])>(skinVert.indices[1]):
-                    #write index
-                    sd.writeShort(indexRemap[skinVert.indices[0]])
-                    #get index
-                    sd.seek(-2, NOESEEK_REL)
-                    index = sd.readShort()
-                    #write weightIndex
-                    sd.writeShort(indexRemap[skinVert.indices[1]])
-                    #get weightIndex
-                    sd.seek(-2, NOESEEK_REL)
-                    weightIndex = sd.readShort()
-                    #write weight
-                    sd.writeFloat(skinVert.weights[1])
-                    #get weight
-                    sd.seek(-4, NOESEEK_REL)
-                    weight = sd.readFloat()
-                    sd.seek(transforms)
-                    if index > weightIndex:
-                        bone = finalJointList[weightIndex]
-                        bone2 = finalJointList[index]
-                        mat2 = bone.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        mat3 = bone2.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        sd.writeFloat(-mat2[3][0] + mat3[3][0])
-                        sd.writeFloat(-mat2[3][1] + mat3[3][1])
-                        sd.writeFloat(-mat2[3][2] + mat3[3][2])
-                        sd.writeFloat(1)
-                        sd.writeInt(8)
-                        sd.writeShort(vertIdx + virtsBefore)
-                        sd.writeShort(vertIdx + virtsBefore)
-                        sd.writeShort(index)
-                        sd.writeShort(weightIndex)
-                        sd.writeFloat(weight)
-                    if weightIndex > index:
-                        bone = finalJointList[weightIndex]
-                        bone2 = finalJointList[index]
-                        mat2 = bone.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        mat3 = bone2.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        sd.writeFloat(-mat2[3][0] + mat3[3][0])
-                        sd.writeFloat(-mat2[3][1] + mat3[3][1])
-                        sd.writeFloat(-mat2[3][2] + mat3[3][2])
-                        sd.writeFloat(1)
-                        sd.writeInt(8)
-                        sd.writeShort(vertIdx + virtsBefore)
-                        sd.writeShort(vertIdx + virtsBefore)
-                        sd.writeShort(index)
-                        sd.writeShort(weightIndex)
-                        sd.writeFloat(weight)
-
-                if (skinVert.indices[0])<(skinVert.indices[1]):
-                    #write index
-                    sd.writeShort(indexRemap[skinVert.indices[1]])
-                    #get index
-                    sd.seek(-2, NOESEEK_REL)
-                    index = sd.readShort()
-                    #write weightIndex
-                    sd.writeShort(indexRemap[skinVert.indices[0]])
-                    #get weightIndex
-                    sd.seek(-2, NOESEEK_REL)
-                    weightIndex = sd.readShort()
-                    #write weight
-                    sd.writeFloat(skinVert.weights[0])
-                    #get weight
-                    sd.seek(-4, NOESEEK_REL)
-                    weight = sd.readFloat()
-                    sd.seek(transforms)
-                    if index > weightIndex:
-                        bone = finalJointList[weightIndex]
-                        bone2 = finalJointList[index]
-                        mat2 = bone.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        mat3 = bone2.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        sd.writeFloat(-mat2[3][0] + mat3[3][0])
-                        sd.writeFloat(-mat2[3][1] + mat3[3][1])
-                        sd.writeFloat(-mat2[3][2] + mat3[3][2])
-                    if weightIndex > index:
-                        bone = finalJointList[weightIndex]
-                        bone2 = finalJointList[index]
-                        mat2 = bone.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        mat3 = bone2.getMatrix() * finalJointList [indexRemap[bone.parentIndex]].getMatrix().inverse()
-                        sd.writeFloat(-mat2[3][0] + mat3[3][0])
-                        sd.writeFloat(-mat2[3][1] + mat3[3][1])
-                        sd.writeFloat(-mat2[3][2] + mat3[3][2])
-
-            else:
-                sd.writeShort(indexRemap[skinVert.indices[0]])
-                sd.seek(-2, NOESEEK_REL)
-                index = sd.readShort()
-                sd.writeShort(indexRemap[skinVert.indices[0]])
-                sd.seek(-2, NOESEEK_REL)
-                weightIndex = sd.readShort()
-                sd.writeFloat(skinVert.weights[0])
-                sd.seek(-4, NOESEEK_REL)
-                weight = sd.readFloat()
-
-            finalPos = finalJointList[indexRemap[skinVert.indices[0]]].getMatrix().inverse().transformPoint(mesh.positions[vertIdx])
-            f.append(finalPos)
-        finalPositions.append(f)
-        virtsBefore += len(mesh.positions)
+    sd.writeBytes(virtSegments)
 
     #Write HInfo - THIS IS EXPERIMENTAL AND VERY BROKEN - DELETE THIS BUNCH OF BULLSHIT SOONER OR LATER
 
@@ -1772,7 +2145,6 @@ def meshWriteModel(mdl, bs):
     sd.writeBytes(z.readBytes(8))
 
     if bNoGuns:
-        bNoGuns = True
         sd.seek(endofHInfo)
         sd.seek(-8, NOESEEK_REL)
         sd.writeInt(-1)
@@ -1781,14 +2153,12 @@ def meshWriteModel(mdl, bs):
         sd.seek(132, NOESEEK_REL)
 
     if bNoShotgun:
-        bNoShotgun = True
         sd.seek(endofHInfo)
         sd.seek(-784, NOESEEK_REL)
         sd.writeInt(-1)
         sd.seek(788, NOESEEK_REL)
 
     if bNoGear:
-        bNoGear = True
         sd.seek(endofHInfo)
 
         #HInfo1
@@ -1841,43 +2211,39 @@ def meshWriteModel(mdl, bs):
         sd.seek(12, NOESEEK_REL)
 
 
-    #Write vertices
+    #Write vertices, in the order of their bones and VirtSegments
     startofVertexBuffer = sd.tell()
-    numVerts = 0
-    vortsBefore = 0
-    for m, mesh in enumerate(mdl.meshes):
-        numVerts += len(finalPositions[m])
-    
-        for v, vertexPos in enumerate(finalPositions[m]):
+    numVerts = len(vertexOrder)
+    for newIdx, vertIdx in enumerate(vertexOrder):
+        m, v = vertexSources[vertIdx]
+        mesh = mdl.meshes[m]
+        vertexPos = finalPositions[vertIdx]
     
-            #Positions
-            vt.writeUShort(int(vertexPos[0] / 0.005000000))
-            vt.writeUShort(int(vertexPos[1] / 0.005000000))
-            vt.writeUShort(int(vertexPos[2] / 0.005000000))
+        #Positions
+        vt.writeUShort(int(vertexPos[0] / 0.005000000))
+        vt.writeUShort(int(vertexPos[1] / 0.005000000))
+        vt.writeUShort(int(vertexPos[2] / 0.005000000))
     
-            #Normals
-            vt.writeByte(int(mesh.normals[v][0] * 127 + 0.5000000001))
-            vt.writeByte(int(mesh.normals[v][1] * 127 + 0.5000000001))
-            vt.writeByte(int(mesh.normals[v][2] * 127 + 0.5000000001))
-    
-            #Pad
-            vt.writeByte(0)
-            
-            #BoneID
-            vt.writeShort(v + len(mdl.bones) + vortsBefore)
-            
-            #UV
-            u = int.from_bytes(struct.pack("f", mesh.uvs[v][0]), "little")
-            v = int.from_bytes(struct.pack("f", mesh.uvs[v][1]), "little")
-            if u & 0xFFFF >= 0x8000: u += 1 << 16
-            if v & 0xFFFF >= 0x8000: v += 1 << 16
-            vt.writeUInt(v & 0xFFFF << 16 | u >> 16)
+        #Normals
+        vt.writeByte(int(mesh.normals[v][0] * 127 + 0.5000000001))
+        vt.writeByte(int(mesh.normals[v][1] * 127 + 0.5000000001))
+        vt.writeByte(int(mesh.normals[v][2] * 127 + 0.5000000001))
     
-        vortsBefore += len(mesh.positions)
+        #Pad
+        vt.writeByte(0)
+        
+        #BoneID, the bone of a rigid vertex or the VirtSegment of a blended one
+        vt.writeShort(vertexBoneIds[newIdx])
+        
+        #UV
+        u = int.from_bytes(struct.pack("f", mesh.uvs[v][0]), "little")
+        v = int.from_bytes(struct.pack("f", mesh.uvs[v][1]), "little")
+        if u & 0xFFFF >= 0x8000: u += 1 << 16
+        if v & 0xFFFF >= 0x8000: v += 1 << 16
+        vt.writeUInt(v & 0xFFFF << 16 | u >> 16)
 
     #Write TextureStripInfo (polygons)
     startofFaces = sd.tell()
-    vertsBefore = 0
     offsetlist = []
 
     for m, mesh in enumerate(mdl.meshes):
@@ -1917,11 +2283,10 @@ def meshWriteModel(mdl, bs):
         fc.writeUInt(0) #nextTexture
 
         #Write mesh indices
-        for idx in mesh.indices:
-            fc.writeUShort(idx + vertsBefore)
+        for idx in meshIndices[m]:
+            fc.writeUShort(newIndices[idx])
         while ((fc.tell() & 3) != 0):
             fc.writeByte(0xff) #padding
-        vertsBefore += len(mesh.positions)
         nextTexture = fc.tell()
             #Get offset of the next face section then go back to nextTexture to write it
         fc.seek(startofFaceSection + 16)
@@ -1937,7 +2302,7 @@ def meshWriteModel(mdl, bs):
     sd.seek(boneOffset)
     sd.writeInt(startofBones)
     sd.seek(virtSegmentsCount)
-    sd.writeInt(numVerts)
+    sd.writeInt(len(segments))
     sd.seek(vertexCount)
     sd.writeInt(numVerts)
     sd.seek(vertexOffset)
@@ -2051,3 +2416,401 @@ def meshWriteModel(mdl, bs):
     bs.writeInt(id << 3)
 
     return 1
+
+
+# Headless batch conversion, built on the decoding core. Run the file with python:
+#   python fmt_tr7ae.py <input dir> [<output dir>] [-j <workers>] [--force]
+# Models are written as OBJ (with an MTL) and textures as DDS, mirroring the input tree.
+# Outputs newer than their input are skipped, so an interrupted run can be resumed
+
+BATCH_EXTENSIONS = (".drm", ".tr7aemesh", ".pcd", ".raw")
+
+LEVEL_VERSION = 79824059
+
+class ObjMesh:
+    name = None
+    vertices = None
+    normals = None
+    uvs = None
+
+    # (name, material, indices) of each triangle list
+    groups = None
+
+    # (material, texture id) of each group
+    materials = None
+
+    def __init__(self, name, vertices, normals, uvs):
+        self.name = name
+        self.vertices = vertices
+        self.normals = normals
+        self.uvs = uvs
+        self.groups = []
+        self.materials = []
+
+    def addGroup(self, name, textureId, indices):
+        self.groups.append((name, "Material_" + str(textureId), indices))
+        self.materials.append(("Material_" + str(textureId), textureId))
+
+def unpackFloats(data):
+    return struct.unpack("<%df" % (len(data) // 4), data)
+
+def writeObj(path, objMeshes, textures):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    lines = ["mtllib " + stem + ".mtl"]
+    base = 1
+
+    for objMesh in objMeshes:
+        vertices = unpackFloats(objMesh.vertices)
+        uvs = unpackFloats(objMesh.uvs)
+        normals = unpackFloats(objMesh.normals) if objMesh.normals != None else None
+        count = len(vertices) // 3
+
+        lines.append("o " + objMesh.name)
+        lines.extend("v {} {} {}".format(vertices[v], vertices[v + 1], vertices[v + 2]) for v in range(0, count * 3, 3))
+        lines.extend("vt {} {}".format(uvs[v], 1 - uvs[v + 1]) for v in range(0, count * 2, 2))
+        if normals != None:
+            lines.extend("vn {} {} {}".format(normals[v], normals[v + 1], normals[v + 2]) for v in range(0, count * 3, 3))
+
+        face = "f {0}/{0}/{0} {1}/{1}/{1} {2}/{2}/{2}" if normals != None else "f {0}/{0} {1}/{1} {2}/{2}"
+
+        for name, material, indices in objMesh.groups:
+            indices = struct.unpack("<%dH" % (len(indices) // 2), indices)
+
+            lines.append("g " + name)
+            lines.append("usemtl " + material)
+            lines.extend(face.format(indices[i] + base, indices[i + 1] + base, indices[i + 2] + base) for i in range(0, len(indices) - 2, 3))
+
+        base += count
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    # materials link to the textures written next to the model
+    mtl = []
+    for material, id in dict.fromkeys(material for objMesh in objMeshes for material in objMesh.materials):
+        mtl.append("newmtl " + material)
+        if id in textures:
+            mtl.append("map_Kd " + stem + "_Texture_" + str(id) + ".dds")
+
+    with open(os.path.splitext(path)[0] + ".mtl", "w") as f:
+        f.write("\n".join(mtl) + "\n")
+
+    return [path, os.path.splitext(path)[0] + ".mtl"]
+
+# DDS of a texture, DXT data is copied with its mipmaps, 32 bit textures are stored as BGRA
+
+DDS_HEADER_STRUCT = struct.Struct("<4s7I44x2I4s5I4I4x")
+
+def writeDDS(path, texture):
+    mipCount = 0
+    if texture.format == PCD_FORMAT_DXT1 or texture.format == PCD_FORMAT_DXT5:
+        fourCC = b"DXT1" if texture.format == PCD_FORMAT_DXT1 else b"DXT5"
+        mipCount = texture.mipCount
+        data = texture.data
+        header = DDS_HEADER_STRUCT.pack(b"DDS ", 124, 0x81007 | (DDS_MIPMAPCOUNT if mipCount > 0 else 0), texture.height, texture.width,
+            getDXTLevelSize(texture.width, texture.height, 8 if fourCC == b"DXT1" else 16), 0, mipCount + 1,
+            32, 0x4, fourCC, 0, 0, 0, 0, 0,
+            0x1000 | (0x400008 if mipCount > 0 else 0), 0, 0, 0)
+    else:
+        data = texture.data[:texture.width * texture.height * 4]
+        if texture.pixelFormat == "a8r8g8b8":
+            data = swizzleARGBToBGRA(data)
+        elif texture.pixelFormat == None and texture.format != PCD_FORMAT_RGBA32:
+            print("Texture format " + hex(texture.format) + " unknown, not written")
+            return []
+        header = DDS_HEADER_STRUCT.pack(b"DDS ", 124, 0x100F, texture.height, texture.width, texture.width * 4, 0, 1,
+            32, 0x41, b"\0\0\0\0", 32, 0xFF0000, 0xFF00, 0xFF, 0xFF000000,
+            0x1000, 0, 0, 0)
+
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(data)
+
+    return [path]
+
+def swizzleARGBToBGRA(data):
+    view = memoryview(data)
+    swizzled = bytearray(len(view))
+    swizzled[0::4] = view[3::4]
+    swizzled[1::4] = view[2::4]
+    swizzled[2::4] = view[1::4]
+    swizzled[3::4] = view[0::4]
+
+    return swizzled
+
+# DRM meshes use the texture id bits of tpageid for their material, .tr7aemesh files all of it
+
+def getMeshObj(view, header2, name, fullTpageid = False):
+    mesh = readMesh(view, header2)
+    vertices, normals, uvs, bone_idx, weights = mesh.getVertexBuffers(getBindMatrices(mesh.bones))
+    objMesh = ObjMesh(name, vertices, normals, uvs)
+
+    for mesh_num, subMesh in enumerate(mesh.subMeshes):
+        objMesh.addGroup(getSubMeshName(mesh_num, subMesh), subMesh.tpageid if fullTpageid else subMesh.textureId, subMesh.faces)
+
+    return objMesh
+
+def isLevel(drm):
+    section = drm.sections[0]
+    if section.offset + 0xAC > len(drm.view):
+        return False
+
+    return struct.unpack_from("<I", drm.view, section.offset + 0xA8)[0] == LEVEL_VERSION
+
+# converts one file, returns the paths written
+
+def convertFile(path, outPath):
+    view = mapFile(path)
+    ext = os.path.splitext(path)[1].lower()
+    # outputs keep the source extension, so foo.pcd and foo.raw don't both write foo.dds
+    stem = outPath
+    outputs = []
+
+    if ext == ".pcd":
+        if struct.unpack_from("<I", view, 0x18)[0] == PS3T_MAGIC:
+            return writeDDS(stem + ".dds", readPS3PCD(view, 0x18))
+        return writeDDS(stem + ".dds", readPCD(view, 0x18))
+
+    if ext == ".raw":
+        if struct.unpack_from("<I", view, 4)[0] == 0x80:
+            return writeDDS(stem + ".dds", readRaw(view))
+        return writeDDS(stem + ".dds", readPS3Raw(view))
+
+    if ext == ".tr7aemesh":
+        return writeObj(stem + ".obj", [getMeshObj(view, getMeshFileOffset(view), "Mesh", True)], {})
+
+    # DRMs, either a level or objects
+    drm = SectionList(view)
+    textures = {}
+    for section in drm.sections:
+        if section.type == SECTION_TEXTURE:
+            textures[section.id] = drm.readTexture(section)
+
+    objMeshes = []
+
+    if isLevel(drm):
+        for i, bgObject in enumerate(readLevel(drm) or []):
+            objMesh = ObjMesh("BGObject_" + str(i), bgObject.vertices, None, bgObject.uvs)
+            for s, strip in enumerate(bgObject.strips):
+                objMesh.addGroup("BGObject_" + str(i) + "_Strip_" + str(s), strip.tpageid, strip.indices)
+            objMeshes.append(objMesh)
+    else:
+        for m, header2 in enumerate(findDrmMeshes(view, DrmIndex(view))):
+            objMeshes.append(getMeshObj(view, header2, "Model_" + str(m)))
+
+    outputs.extend(writeObj(stem + ".obj", objMeshes, textures))
+
+    for id, texture in textures.items():
+        outputs.extend(writeDDS(stem + "_Texture_" + str(id) + ".dds", texture))
+
+    return outputs
+
+# Texture import, DDS textures named <n>_<id> to .pcd sections. Without Noesis nothing can
+# be encoded, so the DXT data and mipmaps of the DDS are copied as they are
+
+PCD_SOURCE_EXTENSIONS = (".dds", ".png")
+
+def convertTextureToPCD(path, outPath):
+    id = parseSectionId(os.path.basename(path))
+    if id == None:
+        raise ValueError("no <n>_<id> section id in the file name")
+
+    dds = readDDS(mapFile(path))
+    if dds == None:
+        raise ValueError("not a DDS file, PNG textures need Noesis")
+
+    if dds.format != PCD_FORMAT_DXT1 and dds.format != PCD_FORMAT_DXT5:
+        raise ValueError("DDS is not DXT1 or DXT5, it needs Noesis to encode it")
+
+    if dds.mipCount == 0:
+        raise ValueError("DDS has no mipmaps, it needs Noesis to build them")
+
+    numMipmaps = min(dds.mipCount, getMipCount(dds.width, dds.height))
+    imageData = bytes(dds.data[:getDXTChainSize(dds.width, dds.height, getDXTBlockSize(dds.format), numMipmaps)])
+    formatMagic = "DXT1" if dds.format == PCD_FORMAT_DXT1 else "DXT5"
+
+    output = os.path.splitext(outPath)[0] + ".pcd"
+    with open(output, "wb") as f:
+        f.write(packPCD(id, formatMagic, dds.width, dds.height, imageData, numMipmaps))
+
+    return [output]
+
+# the output every input is checked against to skip it. Textures to PCD keep the <n>_<id>
+# name the game uses, everything else keeps the source extension (foo.pcd.dds, foo.drm.obj)
+def getBatchOutput(path, outPath, toPCD = False):
+    ext = os.path.splitext(path)[1].lower()
+    if toPCD:
+        return os.path.splitext(outPath)[0] + ".pcd"
+
+    return outPath + (".dds" if ext == ".pcd" or ext == ".raw" else ".obj")
+
+def convertBatchFile(path, outPath, toPCD = False):
+    start = time.perf_counter()
+
+    try:
+        os.makedirs(os.path.dirname(outPath) or ".", exist_ok = True)
+        outputs = convertTextureToPCD(path, outPath) if toPCD else convertFile(path, outPath)
+    except Exception as e:
+        return path, None, time.perf_counter() - start, repr(e)
+
+    return path, sum(os.path.getsize(output) for output in outputs), time.perf_counter() - start, None
+
+# returns the files to convert, how many are up to date and how many are refused because
+# their output is also an input or the output of another input
+
+def findBatchFiles(inDir, outDir, force = False, toPCD = False):
+    extensions = PCD_SOURCE_EXTENSIONS if toPCD else BATCH_EXTENSIONS
+    paths = []
+
+    for root, dirs, names in os.walk(inDir):
+        dirs.sort()
+        for name in sorted(names):
+            if os.path.splitext(name)[1].lower() in extensions:
+                paths.append(os.path.join(root, name))
+
+    inputs = set(os.path.normcase(os.path.abspath(path)) for path in paths)
+    outputs = {}
+    files = []
+    skipped = 0
+    conflicts = 0
+
+    for path in paths:
+        outPath = os.path.join(outDir, os.path.relpath(path, inDir))
+        output = getBatchOutput(path, outPath, toPCD)
+        key = os.path.normcase(os.path.abspath(output))
+
+        if key in inputs or key in outputs:
+            print("Not converting " + path + ", its output " + output + " is also " + (outputs[key] if key in outputs else "an input"))
+            conflicts += 1
+            continue
+        outputs[key] = path
+
+        if not force and os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(path):
+            skipped += 1
+            continue
+
+        files.append((path, outPath))
+
+    return files, skipped, conflicts
+
+def batchConvert(inDir, outDir, workers = None, force = False, toPCD = False):
+    start = time.perf_counter()
+    files, skipped, failed = findBatchFiles(inDir, outDir, force, toPCD)
+    converted = len(files)
+    totalIn = 0
+    totalOut = 0
+
+    print("{} files to convert, {} up to date".format(len(files), skipped))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as pool:
+        futures = [pool.submit(convertBatchFile, path, outPath, toPCD) for path, outPath in files]
+
+        for future in concurrent.futures.as_completed(futures):
+            path, outSize, seconds, error = future.result()
+            inSize = os.path.getsize(path)
+            name = os.path.relpath(path, inDir)
+
+            if error != None:
+                failed += 1
+                converted -= 1
+                print("{:8.1f} ms  {:>10} bytes  failed      {}: {}".format(seconds * 1000, inSize, name, error))
+                continue
+
+            totalIn += inSize
+            totalOut += outSize
+            print("{:8.1f} ms  {:>10} bytes  -> {:>10}  {}".format(seconds * 1000, inSize, outSize, name))
+
+    seconds = time.perf_counter() - start
+    print("{} converted, {} failed, {} skipped, {} -> {} bytes in {:.2f} s".format(converted, failed, skipped, totalIn, totalOut, seconds))
+    printThroughput(converted, totalIn, seconds, "textures" if toPCD else "files")
+
+    return failed == 0
+
+def printThroughput(count, size, seconds, noun):
+    seconds = max(seconds, 1e-6)
+    print("{:.1f} {}/s, {:.2f} MB/s".format(count / seconds, noun, size / seconds / (1024 * 1024)))
+
+# Same texture import from the Noesis tools menu. DXT1/DXT5 DDS textures with mipmaps are
+# copied like above on a thread pool. Everything else is decoded and encoded by Noesis on the
+# calling thread, since rapi isn't known to be safe to call from other threads
+
+def encodeTextureToPCD(rgba, width, height, id, output):
+    # DXT5 only if some pixel isn't opaque
+    format = noesis.NOE_ENCODEDXT_BC3 if min(memoryview(rgba)[3::4]) < 255 else noesis.NOE_ENCODEDXT_BC1
+    formatMagic = "DXT5" if format == noesis.NOE_ENCODEDXT_BC3 else "DXT1"
+
+    levels = [rapi.imageEncodeDXT(rgba, 4, width, height, format)]
+    levels.extend(encodeMipChain(rgba, width, height, format))
+
+    with open(output, "wb") as f:
+        f.write(packPCD(id, formatMagic, width, height, b"".join(levels), len(levels) - 1))
+
+    return [output]
+
+def pcdBatchTool(toolIndex):
+    inDir = noesis.userPrompt(noesis.NOEUSERVAL_FOLDERPATH, "Batch PCD", "Choose a directory of DDS/PNG textures named <n>_<id>", noesis.getSelectedDirectory(), None)
+    if inDir == None:
+        return 0
+
+    start = time.perf_counter()
+    files, skipped, failed = findBatchFiles(inDir, inDir, toPCD = True)
+    converted = len(files)
+    futures = []
+    totalIn = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = os.cpu_count()) as pool:
+        for path, outPath in files:
+            # a texture that can't be read only fails itself, the others are still converted
+            try:
+                id = parseSectionId(os.path.basename(path))
+                if id == None:
+                    raise ValueError("no <n>_<id> section id in the file name")
+
+                # only DXT1/DXT5 with mipmaps can be copied, everything else is encoded
+                dds = readDDS(mapFile(path))
+                if dds != None and dds.mipCount > 0 and (dds.format == PCD_FORMAT_DXT1 or dds.format == PCD_FORMAT_DXT5):
+                    futures.append((path, pool.submit(convertTextureToPCD, path, outPath)))
+                    continue
+
+                texture = rapi.loadExternalTex(path)
+                if texture == None:
+                    raise ValueError("Noesis can't load it")
+
+                encodeTextureToPCD(rapi.imageGetTexRGBA(texture), texture.width, texture.height, id, getBatchOutput(path, outPath, True))
+            except Exception as e:
+                print("Failed to convert " + path + ": " + repr(e))
+                failed += 1
+                converted -= 1
+                continue
+
+            totalIn += os.path.getsize(path)
+            print("Converted " + path)
+
+        for path, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print("Failed to convert " + path + ": " + repr(e))
+                failed += 1
+                converted -= 1
+                continue
+
+            totalIn += os.path.getsize(path)
+            print("Converted " + path)
+
+    seconds = time.perf_counter() - start
+    print("{} converted, {} failed, {} skipped in {:.2f} s".format(converted, failed, skipped, seconds))
+    printThroughput(converted, totalIn, seconds, "textures")
+
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Convert TR7AE .drm, .tr7aemesh, .pcd and .raw files to OBJ and DDS")
+    parser.add_argument("input", help = "directory to convert, searched recursively")
+    parser.add_argument("output", nargs = "?", help = "output directory, the input directory by default")
+    parser.add_argument("-j", "--jobs", type = int, default = None, help = "worker processes, all cores by default")
+    parser.add_argument("--force", action = "store_true", help = "convert files even if their output is up to date")
+    parser.add_argument("--topcd", action = "store_true", help = "convert DXT1/DXT5 DDS textures named <n>_<id> to .pcd instead")
+    args = parser.parse_args()
+
+    raise SystemExit(0 if batchConvert(args.input, args.output or args.input, args.jobs, args.force, args.topcd) else 1)
@@ -0,0 +1,62 @@
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fmt_tr7ae
+
+def writeFile(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def readFile(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def convertAll(inDir, toPCD = False):
+    files, skipped, conflicts = fmt_tr7ae.findBatchFiles(inDir, inDir, toPCD = toPCD)
+    for path, outPath in files:
+        path, outSize, seconds, error = fmt_tr7ae.convertBatchFile(path, outPath, toPCD)
+        assert error == None, error
+
+    return files, conflicts
+
+class BatchOutputTest(unittest.TestCase):
+    def testCollidingStems(self):
+        with tempfile.TemporaryDirectory() as inDir:
+            # a PC pcd and a PC raw texture with the same stem
+            writeFile(os.path.join(inDir, "foo.pcd"), bytes(0x18) + struct.pack("<4s4sIIHHBBH", b"PCD9", b"DXT1", 8, 0, 4, 4, 0, 0, 3) + bytes(range(8)))
+            writeFile(os.path.join(inDir, "foo.raw"), struct.pack("<4sII8xii", b"!WAR", 0x80, 64, 4, 4).ljust(0x80, b"\0") + bytes(range(64)))
+
+            files, conflicts = convertAll(inDir)
+            self.assertEqual(len(files), 2)
+            self.assertEqual(conflicts, 0)
+            self.assertTrue(os.path.isfile(os.path.join(inDir, "foo.pcd.dds")))
+            self.assertTrue(os.path.isfile(os.path.join(inDir, "foo.raw.dds")))
+
+            # both are up to date on the next run
+            files, skipped, conflicts = fmt_tr7ae.findBatchFiles(inDir, inDir)
+            self.assertEqual((len(files), skipped), (0, 2))
+
+    def testCollidingTexturesToPCD(self):
+        with tempfile.TemporaryDirectory() as inDir:
+            dds = os.path.join(inDir, "5_10.dds")
+            fmt_tr7ae.writeDDS(dds, fmt_tr7ae.TextureData(fmt_tr7ae.PCD_FORMAT_DXT1, 8, 8, 1, bytes(range(40))))
+            writeFile(os.path.join(inDir, "5_10.png"), b"\x89PNG\r\n\x1a\n")
+            original = readFile(dds)
+
+            files, conflicts = convertAll(inDir, True)
+            self.assertEqual([os.path.basename(path) for path, outPath in files], ["5_10.dds"])
+            self.assertEqual(conflicts, 1)
+
+            # converting the directory again must not write the new pcd over the source dds
+            files, conflicts = convertAll(inDir)
+            self.assertEqual(conflicts, 0)
+            self.assertEqual(readFile(dds), original)
+            self.assertTrue(os.path.isfile(os.path.join(inDir, "5_10.pcd.dds")))
+
+if __name__ == "__main__":
+    unittest.main()
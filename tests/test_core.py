@@ -0,0 +1,149 @@
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fmt_tr7ae
+
+IDENTITY = ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0), (0.0, 0.0, 0.0))
+
+# tr7aemesh model with two bones, one VirtSegment, three vertices and one sub mesh
+
+def packMesh():
+    m = bytearray(0x170)
+    struct.pack_into("<IIII3f", m, 0, fmt_tr7ae.MESH_MAGIC, 2, 3, 0x60, 0.5, 1.0, 2.0)
+    struct.pack_into("<II", m, 0x20, 3, 0x120)
+    struct.pack_into("<I", m, 0x58, 0x150)
+
+    # bones, then bone id 2 blends a quarter of bone 1 into bone 0
+    struct.pack_into("<3f4xI4xII", m, 0x60 + 0x20, 0.0, 0.0, 0.0, 0, 0xFFFFFFFF, 0)
+    struct.pack_into("<3f4xI4xII", m, 0xA0 + 0x20, 1.0, 2.0, 3.0, 0, 0, 0)
+    struct.pack_into("<HHf", m, 0xE0 + 0x38, 0, 1, 0.25)
+
+    # position, normal, bone id and the upper 16 bits of both uv floats
+    struct.pack_into("<3h3bxH2H", m, 0x120, 2, 4, 6, 127, 0, 0, 0, 0x3F80, 0x3F00)
+    struct.pack_into("<3h3bxH2H", m, 0x130, 10, 0, 0, 0, 127, 0, 1, 0, 0x3F80)
+    struct.pack_into("<3h3bxH2H", m, 0x140, 0, 0, -4, 0, 0, -127, 2, 0x4000, 0)
+
+    # texture 5, blend value 2, single sided, followed by the sub mesh without faces
+    struct.pack_into("<HHiffI3H", m, 0x150, 3, 1, 5 | (2 << 13) | (1 << 21), 0.0, 0.0, 0x16A, 0, 1, 2)
+
+    return bytes(m)
+
+def packPCD9(format, width, height, mipCount, data):
+    return struct.pack("<4sIIIHHBBH", b"PCD9", format, len(data), 0, width, height, 0, mipCount, 3) + data
+
+# DRM of (type, id, relocations as (section, offset), data) sections
+
+def packDrm(sections):
+    drm = bytearray(struct.pack("<II", 14, len(sections)))
+    for type, id, relocations, data in sections:
+        drm += struct.pack("<IB3xIII", len(data), type, len(relocations) << 8, id, 0xFFFFFFFF)
+
+    for type, id, relocations, data in sections:
+        for section, offset in relocations:
+            drm += struct.pack("<hHI", section << 3, 0, offset)
+        drm += data
+
+    return bytes(drm)
+
+TEXTURE = packPCD9(fmt_tr7ae.PCD_FORMAT_DXT1, 4, 4, 0, bytes(range(8)))
+
+# section 1 points at 0x10 into section 2
+DRM = packDrm([
+    (5, 7, [], TEXTURE),
+    (0, 1, [(2, 4)], struct.pack("<II", 0, 0x10)),
+    (1, 3, [], bytes(0x20)),
+    (5, 9, [], TEXTURE)])
+
+DRM_OFFSETS = [0x58, 0x58 + len(TEXTURE), 0x58 + len(TEXTURE) + 16, 0x58 + len(TEXTURE) + 48]
+
+class MeshTest(unittest.TestCase):
+    def testReadMesh(self):
+        # the model doesn't start the buffer, its offsets are relative to its start
+        mesh = fmt_tr7ae.readMesh(memoryview(bytes(0x10) + packMesh()), 0x10)
+
+        self.assertEqual((mesh.boneCount1, mesh.boneCount2, mesh.boneData), (2, 3, 0x70))
+        self.assertEqual(mesh.scale, (0.5, 1.0, 2.0))
+        self.assertEqual([(bone.pos, bone.parent, bone.hinfo) for bone in mesh.bones], [((0.0, 0.0, 0.0), 0xFFFFFFFF, None), ((1.0, 2.0, 3.0), 0, None)])
+        self.assertEqual((mesh.vertCount, mesh.vertStart), (3, 0x130))
+
+        self.assertEqual(len(mesh.subMeshes), 1)
+        subMesh = mesh.subMeshes[0]
+        self.assertEqual((subMesh.faceCount, subMesh.drawGroup), (3, 1))
+        self.assertEqual((subMesh.textureId, subMesh.blendValue, subMesh.singleSided), (5, 2, 1))
+        self.assertEqual(struct.unpack("<3H", subMesh.faces), (0, 1, 2))
+
+    def testVertexBuffers(self):
+        mesh = fmt_tr7ae.readMesh(memoryview(packMesh()), 0)
+        matrices = [IDENTITY, IDENTITY[:3] + ((10.0, 20.0, 30.0),)]
+        positions, normals, uvs, boneIndices, weights = mesh.getVertexBuffers(matrices)
+
+        # scaled, then moved by the matrix of the first bone of each vertex
+        self.assertEqual(struct.unpack("<9f", positions), (1.0, 4.0, 12.0, 15.0, 20.0, 30.0, 0.0, 0.0, -8.0))
+        self.assertEqual(struct.unpack("<9f", normals), (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, -1.0))
+        self.assertEqual(struct.unpack("<6f", uvs), (1.0, 0.5, 0.0, 1.0, 2.0, 0.0))
+
+        # rigid bones weigh 1, the VirtSegment blends index and weightIndex
+        self.assertEqual(struct.unpack("<6H", boneIndices), (0, 0, 1, 0, 0, 1))
+        self.assertEqual(struct.unpack("<6f", weights), (1.0, 0.0, 1.0, 0.0, 0.75, 0.25))
+
+class TextureHeaderTest(unittest.TestCase):
+    def testReadPCD(self):
+        texture = fmt_tr7ae.readPCD(memoryview(bytes(0x18) + packPCD9(fmt_tr7ae.PCD_FORMAT_DXT5, 8, 4, 2, bytes(range(48)))), 0x18)
+
+        self.assertEqual((texture.format, texture.width, texture.height, texture.mipCount), (fmt_tr7ae.PCD_FORMAT_DXT5, 8, 4, 2))
+        self.assertEqual(bytes(texture.data), bytes(range(48)))
+
+    def testReadPS3PCD(self):
+        header = struct.pack(">4sI4xBB6xHH12x", b"PS3T", 16, fmt_tr7ae.PS3_TEXTURE_DXT1, 3, 8, 4)
+        texture = fmt_tr7ae.readPS3PCD(memoryview(bytes(0x18) + header + bytes(range(16))), 0x18)
+
+        # the format is translated and the mip count doesn't include the top level
+        self.assertEqual((texture.format, texture.width, texture.height, texture.mipCount), (fmt_tr7ae.PCD_FORMAT_DXT1, 8, 4, 2))
+        self.assertEqual(bytes(texture.data), bytes(range(16)))
+
+    def testReadRaw(self):
+        raw = struct.pack("<4sII8xii", b"!WAR", 0x80, 32, 4, 2).ljust(0x80, b"\0") + bytes(range(32))
+        texture = fmt_tr7ae.readRaw(memoryview(raw))
+
+        self.assertEqual((texture.format, texture.width, texture.height, texture.mipCount, texture.pixelFormat), (None, 4, 2, 0, "b8g8r8a8"))
+        self.assertEqual(bytes(texture.data), bytes(range(32)))
+
+class DrmTest(unittest.TestCase):
+    def testDrmIndex(self):
+        drm = fmt_tr7ae.DrmIndex(DRM)
+
+        self.assertEqual(drm.ids, [7, 1, 3, 9])
+        self.assertEqual(drm.types, [5, 0, 1, 5])
+        self.assertEqual(drm.itemEntries, [0, 1, 0, 0])
+
+        # entry offsets include the relocations before the data
+        self.assertEqual(drm.offsets, DRM_OFFSETS)
+        self.assertEqual(drm.byType(5), [0, 3])
+        self.assertEqual(drm.byType(0), [1])
+
+    def testSectionList(self):
+        drm = fmt_tr7ae.SectionList(DRM, headerOnly = True)
+
+        # section offsets skip the relocations
+        self.assertEqual([section.offset for section in drm.sections], [DRM_OFFSETS[0], DRM_OFFSETS[1] + 8, DRM_OFFSETS[2], DRM_OFFSETS[3]])
+        self.assertEqual([section.relocations for section in drm.sections], [[], [], [], []])
+
+        drm.readRelocations()
+        section = drm.sections[1]
+        self.assertEqual([(relocation.section, relocation.offset) for relocation in section.relocations], [(2, 4)])
+
+        pointer = drm.pointerAt(section, section.offset + 4)
+        self.assertIs(pointer.section, drm.sections[2])
+        self.assertEqual(pointer.offset, drm.sections[2].offset + 0x10)
+        self.assertIsNone(drm.pointerAt(section, section.offset))
+
+        texture = drm.readTexture(drm.sections[3])
+        self.assertEqual((texture.format, texture.width, texture.height), (fmt_tr7ae.PCD_FORMAT_DXT1, 4, 4))
+        self.assertEqual(bytes(texture.data), bytes(range(8)))
+
+if __name__ == "__main__":
+    unittest.main()
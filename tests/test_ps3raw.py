@@ -0,0 +1,27 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fmt_tr7ae
+
+class TwiddleTest(unittest.TestCase):
+    def testRoundTrip(self):
+        random.seed(16)
+
+        for width, height in ((8, 8), (16, 4), (4, 16), (2, 8), (64, 1), (1, 32)):
+            data = bytes(random.getrandbits(8) for _ in range(width * height * 4))
+            twiddled = fmt_tr7ae.twiddle32(data, width, height)
+
+            # every level must take exactly width * height pixels, or the next one is misread
+            self.assertEqual(len(twiddled), width * height * 4, (width, height))
+            self.assertEqual(fmt_tr7ae.untwiddle32(twiddled, width, height), data, (width, height))
+
+    def testRectangularOrder(self):
+        # 4x2: the 2x2 blocks are interleaved, the extra column bit follows linearly
+        self.assertEqual(fmt_tr7ae.getMortonTable(4, 2), (0, 2, 4, 6, 1, 3, 5, 7))
+
+if __name__ == "__main__":
+    unittest.main()